@@ -1,11 +1,37 @@
 import argparse
+import atexit
+import collections
+import heapq
+import itertools
+import json
 import logging
 import os
+import sqlite3
+import time
 import traceback
 
-from slack_bolt import App
-
-from utils import db_connect, migrate_db
+from slack_bolt import App, BoltResponse
+from slack_sdk import WebClient
+
+from backfill import Backfill
+from jobs import JobQueue, RecentEvents
+from maintenance import Maintenance, database_paths
+import metrics
+import profiling
+from partitions import Partitions
+from query import SearchQuery
+from search_cache import SearchCache
+from slack_api import (
+    RateLimiter,
+    call,
+    fetch_channels,
+    fetch_members,
+    fetch_users,
+    paginate,
+)
+from user_cache import UserCache
+from utils import EVERYONE, channel_visibility, db_connect, migrate_db, sync_rows
+from write_queue import WriteQueue
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -23,12 +49,109 @@ parser.add_argument(
 parser.add_argument(
     "-p", "--port", default=3333, help="Port to serve on. (default = 3333)"
 )
+parser.add_argument(
+    "--commit-latency",
+    default=200,
+    help=(
+        "Maximum time in milliseconds a new message may wait before it is "
+        "committed to the database. (default = 200)"
+    ),
+)
+parser.add_argument(
+    "--workers",
+    default=4,
+    help=(
+        "Number of background threads handling events, so Slack's requests "
+        "are acked straight away. (default = 4)"
+    ),
+)
+parser.add_argument(
+    "--search-workers",
+    default=2,
+    help=(
+        "Number of searches run at once, on threads of their own so they "
+        "don't hold up archiving. (default = 2)"
+    ),
+)
+parser.add_argument(
+    "--search-budget",
+    default=5000,
+    help=(
+        "Milliseconds a search may run before it's stopped, replying with "
+        "what it found so far. (default = 5000)"
+    ),
+)
+parser.add_argument(
+    "--metrics",
+    action="store_true",
+    help=(
+        "Record handler, Slack API and SQL latencies to serve from /metrics "
+        "(see flask_app.py)."
+    ),
+)
+parser.add_argument(
+    "-s",
+    "--slow-threshold",
+    help=(
+        "Log handlers and SQL statements taking longer than this many "
+        "milliseconds, with their query plans, to the slow_log logger. "
+        "(default = none)"
+    ),
+)
+parser.add_argument(
+    "--maintenance-interval",
+    default=900,
+    help=(
+        "Seconds between WAL checkpoints, statistics updates and incremental "
+        "vacuums of the database, 0 for none (see maintenance.py). "
+        "(default = 900)"
+    ),
+)
+parser.add_argument(
+    "--backup-dir",
+    help="Directory to back the database up to while running. (default = none)",
+)
+parser.add_argument(
+    "--backup-interval",
+    default=86400,
+    help="Seconds between backups to --backup-dir. (default = 86400)",
+)
+parser.add_argument(
+    "--partitioned",
+    action="store_true",
+    help=(
+        "Store new messages in one database per month next to the database "
+        "(see partitions.py). Can't be turned off again."
+    ),
+)
 cmd_args, unknown = parser.parse_known_args()
 
 # Check the environment too
 log_level = os.environ.get("ARCHIVE_BOT_LOG_LEVEL", cmd_args.log_level)
 database_path = os.environ.get("ARCHIVE_BOT_DATABASE_PATH", cmd_args.database_path)
 port = os.environ.get("ARCHIVE_BOT_PORT", cmd_args.port)
+commit_latency = os.environ.get("ARCHIVE_BOT_COMMIT_LATENCY", cmd_args.commit_latency)
+workers = os.environ.get("ARCHIVE_BOT_WORKERS", cmd_args.workers)
+search_workers = os.environ.get("ARCHIVE_BOT_SEARCH_WORKERS", cmd_args.search_workers)
+search_budget = os.environ.get("ARCHIVE_BOT_SEARCH_BUDGET", cmd_args.search_budget)
+metrics_enabled = cmd_args.metrics or os.environ.get(
+    "ARCHIVE_BOT_METRICS", ""
+).lower() in ["1", "true", "yes"]
+slow_threshold = os.environ.get("ARCHIVE_BOT_SLOW_THRESHOLD", cmd_args.slow_threshold)
+# Only set from the environment: a directory to write profiles of the
+# handlers to every ARCHIVE_BOT_PROFILE_INTERVAL seconds (see profiling.py)
+profile_dir = os.environ.get("ARCHIVE_BOT_PROFILE")
+profile_interval = os.environ.get("ARCHIVE_BOT_PROFILE_INTERVAL", 60)
+maintenance_interval = os.environ.get(
+    "ARCHIVE_BOT_MAINTENANCE_INTERVAL", cmd_args.maintenance_interval
+)
+backup_dir = os.environ.get("ARCHIVE_BOT_BACKUP_DIR", cmd_args.backup_dir)
+backup_interval = os.environ.get(
+    "ARCHIVE_BOT_BACKUP_INTERVAL", cmd_args.backup_interval
+)
+partitioned = cmd_args.partitioned or os.environ.get(
+    "ARCHIVE_BOT_PARTITIONED", ""
+).lower() in ["1", "true", "yes"]
 
 # Setup logging
 log_level = log_level.upper()
@@ -36,235 +159,733 @@ assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
 logging.basicConfig(level=getattr(logging, log_level))
 logger = logging.getLogger(__name__)
 
+# Has to happen before the handlers below are defined, so they're timed
+if metrics_enabled:
+    metrics.enable()
+if slow_threshold:
+    profiling.enable_slow_log(float(slow_threshold) / 1000)
+if profile_dir:
+    profiling.enable_profiler(profile_dir, int(profile_interval))
 
+
+# ARCHIVE_BOT_SLACK_API_URL points the bot at another Web API, e.g. a local
+# fake one for testing
+slack_api_url = os.environ.get("ARCHIVE_BOT_SLACK_API_URL")
 app = App(
     token=os.environ.get("SLACK_BOT_TOKEN"),
+    client=(
+        WebClient(token=os.environ.get("SLACK_BOT_TOKEN"), base_url=slack_api_url)
+        if slack_api_url
+        else None
+    ),
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
     logger=logger,
+    # The handlers only queue their work for job_queue, so running them
+    # before responding still acks straight away
+    process_before_response=True,
 )
 
+# Shared by every Web API call the bot makes so it stays within Slack's rate
+# limits
+rate_limiter = RateLimiter()
+
 # Save the bot user's user ID
 app._bot_user_id = app.client.auth_test()["user_id"]
 
+# Monthly message databases, when partitioning is on
+partitions = Partitions(database_path)
+
+# Archive writes from the event handlers are batched and committed by a
+# background thread. Anything still queued is committed on shutdown.
+write_queue = WriteQueue(
+    database_path,
+    max_latency=float(commit_latency) / 1000,
+    connect=partitions.connect,
+)
+atexit.register(write_queue.close)
+
+# Events are handled in the background after Slack's request has been acked.
+# On shutdown the queued events are handled before the write queue is closed
+# (atexit runs in reverse order).
+job_queue = JobQueue(int(workers))
+atexit.register(job_queue.close)
+
+# Searches from DMs run on workers of their own, so a slow one never takes a
+# worker archiving messages. Any more than SEARCH_QUEUE_SIZE waiting are
+# turned away with BUSY_REPLY.
+SEARCH_QUEUE_SIZE = 20
+search_queue = JobQueue(int(search_workers), SEARCH_QUEUE_SIZE, name="search-worker")
+atexit.register(search_queue.close)
+
+# Events already accepted, to skip the ones Slack delivers again
+recent_events = RecentEvents(database_path)
+
+# Database upkeep and backups on a background thread, started by
+# start_background_jobs()
+maintenance = Maintenance(
+    database_paths(partitions),
+    interval=int(maintenance_interval),
+    backup_dir=backup_dir,
+    backup_interval=int(backup_interval),
+)
+
+
+@app.middleware
+def skip_redeliveries(request, body, next):
+    """
+    Acks events Slack sends again (e.g. after a slow ack) without handling
+    them twice, and turns events away with a 503 while the job queue is full
+    so Slack retries them later.
+    """
+    event_id = body.get("event_id")
+    if event_id:
+        if job_queue.full():
+            logger.warning("Job queue full, turning away event %s" % event_id)
+            if metrics.enabled:
+                metrics.events_skipped.inc("busy")
+            return BoltResponse(status=503, body="")
+        if recent_events.add(event_id):
+            retry = request.headers.get("x-slack-retry-num", ["?"])[0]
+            logger.info(
+                "Skipping event %s, delivered again (retry %s)" % (event_id, retry)
+            )
+            if metrics.enabled:
+                metrics.events_skipped.inc("duplicate")
+            return BoltResponse(status=200, body="")
+    next()
+
+
+def user_row(user):
+    return (
+        user["id"],
+        user["profile"]["display_name"],
+        user["profile"].get(
+            "image_72",
+            "http://fst.slack-edge.com/66f9/img/avatars/ava_0024-32.png",
+        ),
+    )
+
+
 # Uses slack API to get most recent user list
 # Necessary for User ID correlation
 def update_users(conn, cursor):
     logger.info("Updating users")
-    info = app.client.users_list()
-
-    args = []
-    for m in info["members"]:
-        args.append(
-            (
-                m["profile"]["display_name"],
-                m["id"],
-                m["profile"].get(
-                    "image_72",
-                    "http://fst.slack-edge.com/66f9/img/avatars/ava_0024-32.png",
-                ),
-            )
+    members = fetch_users(app.client, rate_limiter)
+    args = [user_row(m) for m in members]
+
+    # Users are never removed, archived messages still refer to them
+    with metrics.timer(metrics.sql_seconds, "sync"):
+        counts = sync_rows(
+            cursor, "users", ("id",), ("name", "avatar"), args, delete=False
         )
-    cursor.executemany("INSERT INTO users(name, id, avatar) VALUES(?,?,?)", args)
-    conn.commit()
+        conn.commit()
+    logger.info("Users: %s added, %s changed, %s removed" % counts)
+
+    for m in members:
+        user_cache.add(m["id"])
+
+
+def add_user(user_id):
+    """
+    Adds a single user to the DB if they aren't there yet. Run in the
+    background by user_cache when a message comes from an unknown user.
+    """
+    conn, cursor = db_connect(database_path)
+    with metrics.timer(metrics.sql_seconds, "lookup"):
+        cursor.execute("SELECT 1 FROM users WHERE id = ?", (user_id,))
+        row = cursor.fetchone()
+        cursor.close()
+    if row is None:
+        logger.info("Adding user %s" % user_id)
+        user = call(app.client, rate_limiter, "users.info", user=user_id)["user"]
+        write_queue.execute(
+            "INSERT INTO users(id, name, avatar) VALUES(?,?,?)", user_row(user)
+        )
+
+
+# Users known to be in the DB
+user_cache = UserCache(add_user)
+
+# Recent search results
+search_cache = SearchCache()
+
+
+def database_size():
+    paths = partitions.paths() if partitions.enabled() else [database_path]
+    return sum(
+        os.path.getsize(path)
+        for path in paths + [path + "-wal" for path in paths]
+        if os.path.exists(path)
+    )
+
+
+def count_messages(cursor):
+    # Estimated from the highest rowid, a lookup at the end of the table
+    # instead of a scan of all of it on every scrape. Overcounts by the
+    # messages deleted or replaced (by archiving them again) since.
+    cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages")
+    count = cursor.fetchone()[0]
+    cursor.close()
+    return count
+
+
+def row_counts():
+    conn, cursor = db_connect(database_path)
+    counts = {}
+    # Counted exactly, they're small next to messages
+    for table in ["users", "channels", "members"]:
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        counts[table] = cursor.fetchone()[0]
+    cursor.close()
+    if partitions.enabled():
+        counts["messages"] = sum(partitions.map(count_messages, partitions.paths()))
+    else:
+        counts["messages"] = count_messages(db_connect(database_path)[1])
+    return counts
+
+
+# Read when /metrics is scraped
+metrics.gauge(
+    "archivebot_database_bytes",
+    "Size of the database file and its WAL.",
+    database_size,
+)
+metrics.gauge(
+    "archivebot_rows",
+    "Rows in each table, estimated for messages.",
+    row_counts,
+    label="table",
+)
+metrics.gauge(
+    "archivebot_job_queue_depth",
+    "Events waiting to be handled.",
+    lambda: job_queue.depth(),
+)
+metrics.gauge(
+    "archivebot_search_queue_depth",
+    "Searches waiting for a search worker.",
+    lambda: search_queue.depth(),
+)
+metrics.gauge(
+    "archivebot_write_queue_depth",
+    "Writes waiting to be committed.",
+    lambda: write_queue.depth(),
+)
+metrics.gauge(
+    "archivebot_search_cache",
+    "Search cache size and its hit, miss, eviction and invalidation counts.",
+    lambda: search_cache.stats(),
+    label="stat",
+)
+
+
+def channel_members(channel, members):
+    """
+    Returns the `members` rows to store for a channel archive bot is in.
+    Everyone can search public channels, so only archive bot's own membership
+    is recorded for those. Private channels need the full list.
+    """
+    if not channel["is_private"]:
+        members = [app._bot_user_id]
+    return [(channel["id"], m) for m in members]
 
 
 def get_channel_info(channel_id):
-    channel = app.client.conversations_info(channel=channel_id)["channel"]
+    channel = call(app.client, rate_limiter, "conversations.info", channel=channel_id)[
+        "channel"
+    ]
 
     # Get a list of members for the channel. This will be used when querying private channels.
-    response = app.client.conversations_members(channel=channel["id"])
-    members = response["members"]
-    while response["response_metadata"]["next_cursor"]:
-        response = app.client.conversations_members(
-            channel=channel["id"], cursor=response["response_metadata"]["next_cursor"]
+    members = []
+    if channel["is_private"]:
+        members = list(
+            paginate(
+                app.client,
+                rate_limiter,
+                "conversations.members",
+                "members",
+                channel=channel["id"],
+            )
         )
-        members += response["members"]
 
     return (
         channel["id"],
         channel["name"],
         channel["is_private"],
-        [(channel["id"], m) for m in members],
+        channel_members(channel, members),
     )
 
 
 def update_channels(conn, cursor):
     logger.info("Updating channels")
-    channels = app.client.conversations_list(types="public_channel,private_channel")[
-        "channels"
-    ]
+    channels = [c for c in fetch_channels(app.client, rate_limiter) if c["is_member"]]
+
+    # Fetch the members of all the private channels at once
+    members = fetch_members(
+        app.client, rate_limiter, [c["id"] for c in channels if c["is_private"]]
+    )
 
     channel_args = []
     member_args = []
+    visibility_args = []
     for channel in channels:
-        if channel["is_member"]:
-            channel_id, channel_name, channel_is_private, members = get_channel_info(
-                channel["id"]
+        channel_members_args = channel_members(channel, members.get(channel["id"], []))
+
+        channel_args.append(
+            (channel["id"], channel["name"], int(channel["is_private"]))
+        )
+
+        member_args += channel_members_args
+        visibility_args += channel_visibility(
+            channel["id"], channel["is_private"], [m for _, m in channel_members_args]
+        )
+
+    # Only apply what changed since the last sync. Channels archive bot has
+    # left are kept for their archived messages, but their members aren't.
+    with metrics.timer(metrics.sql_seconds, "sync"):
+        channel_counts = sync_rows(
+            cursor,
+            "channels",
+            ("id",),
+            ("name", "is_private"),
+            channel_args,
+            delete=False,
+        )
+        member_counts = sync_rows(
+            cursor, "members", ("channel", "user"), (), member_args
+        )
+        sync_rows(cursor, "visibility", ("user", "channel"), (), visibility_args)
+        conn.commit()
+    logger.info("Channels: %s added, %s changed, %s removed" % channel_counts)
+    logger.info("Members: %s added, %s changed, %s removed" % member_counts)
+
+
+# Longest search results message to send. Slack truncates messages at 40,000
+# characters but is much happier with shorter ones.
+MAX_MESSAGE_LENGTH = 3500
+
+# SQLite virtual machine instructions between checks of a search's time
+# budget (see --search-budget)
+SEARCH_PROGRESS_STEPS = 1000
+
+BUSY_REPLY = "Archive bot is busy with other searches, try again in a moment"
+REFINE_REPLY = (
+    "That search took too long. Try refining it with more words, "
+    "from:<user>, in:<channel> or after:/before:<date>"
+)
+PARTIAL_NOTE = (
+    "_That search took too long, so these may not be all the results. Refine "
+    "it with more words, from:, in: or a date to see the rest_"
+)
+
+
+def search(cursor, user, query, after=None, deadline=None):
+    """
+    Runs a parsed search for `user`, returning one page of results.
+
+    Results are ordered by a unique sort key: (timestamp, channel), preceded
+    by the bm25 rank when sorting by relevance. `after` is the sort key of
+    the last result of the previous page, and the next page starts straight
+    after it in the index (keyset pagination) instead of skipping over the
+    earlier pages again.
+
+    A search still running at `deadline` (a time.monotonic() time) is
+    stopped, and returns the rows it found until then.
+
+    Returns the rows (message, user, timestamp, channel, *sort key), the
+    sort key to continue after, or None if this was the last page, and
+    whether the search finished. A search that was stopped has no next page.
+    """
+    if partitions.enabled():
+        rows, complete = search_partitions(user, query, after, deadline)
+    else:
+        rows, complete = search_rows(cursor, user, query, after, deadline)
+
+    limit = query.limit
+    last = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if complete:
+            last = list(rows[-1][4:])
+    return rows, last, complete
+
+
+def search_partitions(user, query, after=None, deadline=None):
+    """
+    Runs search_rows on the archive database and every partition that may
+    hold results, in parallel, and merges their rows.
+
+    Relevance ranks come from each database's own full-text index, so they
+    only roughly compare across partitions.
+    """
+    since, until = query.since, query.until
+    # When sorting by date, later pages only need the partitions from where
+    # the last one ended (the first sort key is the timestamp)
+    if after and query.sort == "asc":
+        since = max(since or after[0], after[0])
+    elif after and query.sort == "desc":
+        # + 1 to keep the month of `after`, which may start at that timestamp
+        until = min(until or after[0] + 1, after[0] + 1)
+
+    results = partitions.map(
+        lambda cursor: search_rows(cursor, user, query, after, deadline),
+        partitions.paths(since, until),
+    )
+    rows = heapq.merge(
+        *(rows for rows, _ in results),
+        key=lambda row: row[4:],
+        reverse=query.sort == "desc",
+    )
+    complete = all(complete for _, complete in results)
+    return list(itertools.islice(rows, query.limit + 1)), complete
+
+
+def search_rows(cursor, user, query, after=None, deadline=None):
+    """
+    Runs a parsed search on the messages of one database, returning up to
+    one row more than the query's limit, so the caller can tell whether
+    there's another page, and whether the search finished before
+    `deadline`.
+    """
+    if deadline is not None and time.monotonic() > deadline:
+        # Out of time while waiting for a thread to search this partition
+        return [], False
+
+    match = query.match()
+    if match:
+        source = """
+            messages_fts
+            INNER JOIN messages ON messages.rowid = messages_fts.rowid
+        """
+    else:
+        source = "messages"
+
+    keys = ["messages.ts", "messages.channel"]
+    if match and not query.sort:
+        # Best matches (lowest bm25 score) first
+        keys.insert(0, "messages_fts.rank")
+    descending = query.sort == "desc"
+
+    sql = f"""
+        SELECT
+            messages.message, messages.user, messages.timestamp, messages.channel,
+            {", ".join(keys)}
+        FROM {source}
+        WHERE
+            -- Only return messages in channels archive bot is a part of that are
+            -- public or that the user is a member of
+            messages.channel IN (
+                SELECT channel FROM visibility WHERE user IN (?, ?)
             )
+    """
+    args = [EVERYONE, user]
+
+    if match:
+        sql += " AND messages_fts MATCH (?)"
+        args.append(match)
+    if query.user_name:
+        sql += " AND messages.user IN (SELECT id FROM users WHERE name = (?))"
+        args.append(query.user_name)
+    if query.channel_name:
+        sql += " AND messages.channel IN (SELECT id FROM channels WHERE name = (?))"
+        args.append(query.channel_name)
+    # Plain comparisons on ts, so SQLite can use the ts indexes for the range
+    if query.since is not None:
+        sql += " AND messages.ts >= (?)"
+        args.append(query.since)
+    if query.until is not None:
+        sql += " AND messages.ts < (?)"
+        args.append(query.until)
+    if after:
+        sql += " AND (%s) %s (%s)" % (
+            ", ".join(keys),
+            "<" if descending else ">",
+            ", ".join("?" * len(keys)),
+        )
+        args += after
+    sql += " ORDER BY " + ", ".join(
+        "%s %s" % (k, "DESC" if descending else "ASC") for k in keys
+    )
 
-            channel_args.append((channel_name, channel_id, channel_is_private))
+    logger.debug(sql)
+    logger.debug(args)
 
-            member_args += members
+    conn = cursor.connection
+    if deadline is not None:
+        # SQLite interrupts the statement once the handler returns true
+        conn.set_progress_handler(
+            lambda: time.monotonic() > deadline, SEARCH_PROGRESS_STEPS
+        )
 
-    cursor.executemany(
-        "INSERT INTO channels(name, id, is_private) VALUES(?,?,?)", channel_args
+    # Fetch one extra row to find out if there's another page
+    rows = []
+    complete = True
+    start = time.perf_counter()
+    with metrics.timer(metrics.sql_seconds, "search"):
+        try:
+            cursor.execute(sql, args)
+            # One row at a time, to keep the ones found before an interrupt
+            for row in cursor:
+                rows.append(row)
+                if len(rows) > query.limit:
+                    break
+        except sqlite3.OperationalError:
+            if deadline is None or time.monotonic() <= deadline:
+                raise
+            complete = False
+        finally:
+            conn.set_progress_handler(None, 0)
+            # Finish the statement so this pooled connection doesn't keep a
+            # read transaction open (and hold back WAL checkpoints) until its
+            # next use.
+            cursor.close()
+    profiling.log_slow_sql(
+        "search",
+        time.perf_counter() - start,
+        conn,
+        sql,
+        args,
+        len(rows),
+        query=query.to_dict(),
+        complete=complete,
     )
-    cursor.executemany("INSERT INTO members(channel, user) VALUES(?,?)", member_args)
-    conn.commit()
+    return rows, complete
+
+
+def result_messages(rows, more, partial=False):
+    """
+    Formats search results into as few Slack messages as possible, keeping
+    each under MAX_MESSAGE_LENGTH characters. `partial` results end with a
+    note that the search was stopped.
+    """
+    results = [
+        "*<@%s>* _<!date^%s^{date_pretty} {time}|A while ago>_ _<#%s>_\n%s\n\n"
+        % (i[1], int(float(i[2])), i[3], i[0])
+        for i in rows
+    ]
+    if more:
+        results.append("_Reply `next` for more results_")
+    if partial:
+        results.append(PARTIAL_NOTE)
+
+    messages = []
+    current = []
+    length = 0
+    for result in results:
+        if current and length + len(result) + 1 > MAX_MESSAGE_LENGTH:
+            messages.append("\n".join(current))
+            current = []
+            length = 0
+        current.append(result)
+        length += len(result) + 1
+    if current:
+        messages.append("\n".join(current))
+    return messages
+
+
+# Timed as a handler of its own: handle_message only queues the search
+@metrics.timed_handler
+def handle_search(event, say):
+    """
+    Handles a search DM on a search worker, with its own connection.
+    """
+    conn, cursor = db_connect(database_path)
+    handle_query(event, cursor, say)
 
 
 def handle_query(event, cursor, say):
     """
     Handles a DM to the bot that is requesting a search of the archives.
+    See query_replies for the usage.
+    """
+    for reply in query_replies(event, cursor):
+        say(reply)
+
+
+def query_replies(event, cursor):
+    """
+    Runs the search requested in a DM to the bot and returns the messages to
+    reply with.
 
     Usage:
 
-        <query> from:<user> in:<channel> sort:asc|desc limit:<number>
+        <query> from:<user> in:<channel> after:<date> before:<date> during:<date>
+            sort:asc|desc limit:<number>
 
-        query: The text to search for.
+        query: The text to search for. Messages must contain every word.
+            Use "quotes" to search for an exact phrase, or end a word with *
+            to search for words starting with it (e.g. deploy*).
         user: If you want to limit the search to one user, the username.
         channel: If you want to limit the search to one channel, the channel name.
+        date: A day (2021-03-14), month (2021-03) or year (2021), or today or
+            yesterday. after: only searches messages sent after that period,
+            before: messages sent before it and during: (or on:) messages sent
+            during it.
         sort: Either asc if you want to search starting with the oldest messages,
-            or desc if you want to start from the newest. Default asc.
-        limit: The number of responses to return. Default 10.
+            or desc if you want to start from the newest. Default is to return
+            the best matches first.
+        limit: The number of responses to return. Default 10, at most 100.
+
+    If there are more results, replying `next` (or `more`) returns the next
+    page of them. A search taking longer than --search-budget is stopped,
+    replying with the results found so far (without a next page) or asking
+    to refine it.
     """
     try:
-        text = []
-        user_name = None
-        channel_name = None
-        sort = None
-        limit = 10
-
-        params = event["text"].lower().split()
-        for p in params:
-            # Handle emoji
-            # usual format is " :smiley_face: "
-            if len(p) > 2 and p[0] == ":" and p[-1] == ":":
-                text.append(p)
-                continue
-
-            p = p.split(":")
-
-            if len(p) == 1:
-                text.append(p[0])
-            if len(p) == 2:
-                if p[0] == "from":
-                    user_name = p[1]
-                if p[0] == "in":
-                    channel_name = p[1].replace("#", "").strip()
-                if p[0] == "sort":
-                    if p[1] in ["asc", "desc"]:
-                        sort = p[1]
-                    else:
-                        raise ValueError("Invalid sort order %s" % p[1])
-                if p[0] == "limit":
-                    try:
-                        limit = int(p[1])
-                    except:
-                        raise ValueError("%s not a valid number" % p[1])
-
-        query = f"""
-            SELECT DISTINCT
-                messages.message, messages.user, messages.timestamp, messages.channel
-            FROM messages
-            INNER JOIN users ON messages.user = users.id
-            -- Only query channel that archive bot is a part of
-            INNER JOIN (
-                SELECT * FROM channels
-                INNER JOIN members ON
-                    channels.id = members.channel AND
-                    members.user = (?)
-            ) as channels ON messages.channel = channels.id
-            INNER JOIN members ON channels.id = members.channel
-            WHERE
-                -- Only return messages that are in public channels or the user is a member of
-                (channels.is_private <> 1 OR members.user = (?)) AND
-                messages.message LIKE (?)
-        """
-        query_args = [app._bot_user_id, event["user"], "%" + " ".join(text) + "%"]
-
-        if user_name:
-            query += " AND users.name = (?)"
-            query_args.append(user_name)
-        if channel_name:
-            query += " AND channels.name = (?)"
-            query_args.append(channel_name)
-        if sort:
-            query += " ORDER BY messages.timestamp %s" % sort
-
-        logger.debug(query)
-        logger.debug(query_args)
+        user = event["user"]
+        if event["text"].strip().lower() in ["next", "more"]:
+            cursor.execute("SELECT token FROM search_cursors WHERE user = ?", (user,))
+            row = cursor.fetchall()
+            if not row:
+                return ["There's no search to continue"]
+            token = json.loads(row[0][0])
+            query, after = SearchQuery.from_dict(token["query"]), token["after"]
+        else:
+            query, after = SearchQuery.parse(event["text"]), None
+
+        # Serve repeated searches from the cache, as long as nothing that
+        # could change their results has been written since
+        with metrics.timer(metrics.sql_seconds, "lookup"):
+            cursor.execute("SELECT value FROM generation")
+            generation = cursor.fetchall()[0][0]
+            cursor.execute(
+                "SELECT channel FROM visibility WHERE user IN (?, ?) ORDER BY channel",
+                (EVERYONE, user),
+            )
+            channels = [row[0] for row in cursor.fetchall()]
+        key = search_cache.key(query.to_dict(), after, channels)
+
+        cached = search_cache.get(key, generation)
+        if cached is None:
+            deadline = time.monotonic() + float(search_budget) / 1000
+            res, last, complete = search(cursor, user, query, after, deadline)
+            # Stopped searches aren't cached, they may finish next time
+            if complete:
+                search_cache.put(key, generation, (res, last))
+        else:
+            res, last = cached
+            complete = True
+
+        # Remember where this page ended so `next` can continue from there
+        if last:
+            write_queue.execute(
+                "INSERT OR REPLACE INTO search_cursors(user, token) VALUES(?,?)",
+                (user, json.dumps({"query": query.to_dict(), "after": last})),
+            )
+        else:
+            write_queue.execute("DELETE FROM search_cursors WHERE user = ?", (user,))
 
-        cursor.execute(query, query_args)
+        if not complete:
+            logger.info("Search by %s stopped after %s results" % (user, len(res)))
+            if metrics.enabled:
+                metrics.searches_limited.inc("partial" if res else "timeout")
+            if not res:
+                return [REFINE_REPLY]
 
-        res = cursor.fetchmany(limit)
-        res_message = None
         if res:
             logger.debug(res)
-            res_message = "\n".join(
-                [
-                    "*<@%s>* _<!date^%s^{date_pretty} {time}|A while ago>_ _<#%s>_\n%s\n\n"
-                    % (i[1], int(float(i[2])), i[3], i[0])
-                    for i in res
-                ]
-            )
-        if res_message:
-            say(res_message)
-        else:
-            say("No results found")
+            return result_messages(res, more=last is not None, partial=not complete)
+        return ["No results found"]
     except ValueError as e:
         logger.error(traceback.format_exc())
-        say(str(e))
+        return [str(e)]
+
+
+def add_channel(channel_id, channel_name, channel_is_private, members):
+    """
+    Adds a channel archive bot has joined, from what get_channel_info returns.
+    """
+    write_queue.execute(
+        "INSERT INTO channels(name, id, is_private) VALUES(?,?,?)",
+        (channel_name, channel_id, channel_is_private),
+    )
+    write_queue.executemany(
+        "INSERT OR IGNORE INTO members(channel, user) VALUES(?,?)", members
+    )
+    write_queue.execute("DELETE FROM visibility WHERE channel = ?", (channel_id,))
+    write_queue.executemany(
+        "INSERT INTO visibility(user, channel) VALUES(?,?)",
+        channel_visibility(channel_id, channel_is_private, [m for _, m in members]),
+    )
+
+
+def add_member(event):
+    # Only members of private channels are tracked, see channel_members()
+    write_queue.execute(
+        """
+        INSERT OR IGNORE INTO members(channel, user)
+        SELECT id, ? FROM channels WHERE id = ? AND is_private = 1
+        """,
+        (event["user"], event["channel"]),
+    )
+    # New members of private channels archive bot is in can search them
+    write_queue.execute(
+        """
+        INSERT OR IGNORE INTO visibility(user, channel)
+        SELECT ?, id FROM channels
+        WHERE id = ? AND is_private = 1 AND EXISTS (
+            SELECT 1 FROM members WHERE channel = channels.id AND user = ?
+        )
+        """,
+        (event["user"], event["channel"], app._bot_user_id),
+    )
 
 
 @app.event("member_joined_channel")
+@job_queue.background
+@metrics.timed_handler
 def handle_join(event):
-    conn, cursor = db_connect(database_path)
+    # If the user added is archive bot, then add the channel too, and what
+    # was said there before
+    if event["user"] == app._bot_user_id:
+        add_channel(*get_channel_info(event["channel"]))
+        backfill.submit(event["channel"])
+    else:
+        add_member(event)
+
+
+def remove_member(event):
+    write_queue.execute(
+        "DELETE FROM members WHERE channel = ? AND user = ?",
+        (event["channel"], event["user"]),
+    )
 
-    # If the user added is archive bot, then add the channel too
+    # If archive bot left, nobody can search the channel anymore
     if event["user"] == app._bot_user_id:
-        channel_id, channel_name, channel_is_private, members = get_channel_info(
-            event["channel"]
+        write_queue.execute(
+            "DELETE FROM visibility WHERE channel = ?", (event["channel"],)
         )
-        cursor.execute(
-            "INSERT INTO channels(name, id, is_private) VALUES(?,?,?)",
-            (channel_id, channel_name, channel_is_private),
-        )
-        cursor.executemany("INSERT INTO members(channel, user) VALUES(?,?)", members)
     else:
-        cursor.execute(
-            "INSERT INTO members(channel, user) VALUES(?,?)",
+        write_queue.execute(
+            "DELETE FROM visibility WHERE channel = ? AND user = ?",
             (event["channel"], event["user"]),
         )
 
-    conn.commit()
-
 
 @app.event("member_left_channel")
+@job_queue.background
+@metrics.timed_handler
 def handle_left(event):
-    conn, cursor = db_connect(database_path)
-    cursor.execute(
-        "DELETE FROM members WHERE channel = ? AND user = ?",
-        (event["channel"], event["user"]),
-    )
-    conn.commit()
+    remove_member(event)
 
 
 def handle_rename(event):
     channel = event["channel"]
-    conn, cursor = db_connect(database_path)
-    cursor.execute(
+    write_queue.execute(
         "UPDATE channels SET name = ? WHERE id = ?", (channel["name"], channel["id"])
     )
-    conn.commit()
 
 
 @app.event("channel_rename")
+@job_queue.background
+@metrics.timed_handler
 def handle_channel_rename(event):
     handle_rename(event)
 
 
 @app.event("group_rename")
+@job_queue.background
+@metrics.timed_handler
 def handle_group_rename(event):
     handle_rename(event)
 
@@ -272,23 +893,87 @@ def handle_group_rename(event):
 # For some reason slack fires off both *_rename and *_name events, so create handlers for them
 # but don't do anything in the *_name events.
 @app.event({"type": "message", "subtype": "group_name"})
+@metrics.timed_handler
 def handle_group_name():
     pass
 
 
 @app.event({"type": "message", "subtype": "channel_name"})
+@metrics.timed_handler
 def handle_channel_name():
     pass
 
 
-@app.event("user_change")
-def handle_user_change(event):
+def change_user(event):
     user_id = event["user"]["id"]
     new_username = event["user"]["profile"]["display_name"]
 
-    conn, cursor = db_connect(database_path)
-    cursor.execute("UPDATE users SET name = ? WHERE id = ?", (new_username, user_id))
-    conn.commit()
+    write_queue.execute(
+        "UPDATE users SET name = ? WHERE id = ?", (new_username, user_id)
+    )
+    user_cache.add(user_id)
+
+
+@app.event("user_change")
+@job_queue.background
+@metrics.timed_handler
+def handle_user_change(event):
+    change_user(event)
+
+
+def write_messages(sql, rows):
+    """
+    Queues `sql` for each of `rows` (ending with the message's timestamp) on
+    the messages table the message belongs in: the archive database's, or
+    that of its month's partition when partitioning is on (see
+    Partitions.month).
+    """
+    if not partitions.enabled():
+        write_queue.executemany(sql, rows)
+        return
+
+    months = collections.defaultdict(list)
+    for row in rows:
+        months[partitions.month(row[-1])].append(row)
+    archived = months.pop(None, None)
+    if archived:
+        write_queue.executemany(sql, archived)
+    if not months:
+        return
+    for month, month_rows in months.items():
+        write_queue.executemany(sql, month_rows, partitions.path(month))
+        write_queue.execute(
+            "INSERT OR IGNORE INTO partitions(month) VALUES(?)", (month,)
+        )
+    # The archive database's triggers don't see writes to partitions, so
+    # bump the generation for the search cache here. Committed after the
+    # partitions (see WriteQueue).
+    write_queue.execute("UPDATE generation SET value = value + 1")
+
+
+def archive_message(message):
+    write_messages(
+        "INSERT INTO messages VALUES(?, ?, ?, ?)",
+        [(message["text"], message["user"], message["channel"], message["ts"])],
+    )
+
+    # Ensure that the user exists in the DB
+    user_cache.ensure(message["user"])
+
+
+def archive_history(rows):
+    """
+    Archives (text, user, channel, ts) rows of earlier messages from
+    backfill. Messages already archived are left as they are, they may have
+    been edited since.
+    """
+    write_messages("INSERT OR IGNORE INTO messages VALUES(?, ?, ?, ?)", rows)
+    for user in set(row[1] for row in rows):
+        user_cache.ensure(user)
+
+
+# Archives the history of channels archive bot joins
+backfill = Backfill(app.client, rate_limiter, write_queue, archive_history)
 
 
 def handle_message(message, say):
@@ -296,62 +981,85 @@ def handle_message(message, say):
     if "text" not in message or message["user"] == "USLACKBOT":
         return
 
-    conn, cursor = db_connect(database_path)
-
     # If it's a DM, treat it as a search query
     if message["channel_type"] == "im":
-        handle_query(message, cursor, say)
+        if search_queue.full():
+            logger.warning("Search queue full, turning away a search")
+            if metrics.enabled:
+                metrics.searches_limited.inc("busy")
+            say(BUSY_REPLY)
+        else:
+            # By keyword, for the slow log's description of the event
+            search_queue.submit(handle_search, event=message, say=say)
     elif "user" not in message:
         logger.warning("No valid user. Previous event not saved")
     else:  # Otherwise save the message to the archive.
-        cursor.execute(
-            "INSERT INTO messages VALUES(?, ?, ?, ?)",
-            (message["text"], message["user"], message["channel"], message["ts"]),
-        )
-        conn.commit()
-
-        # Ensure that the user exists in the DB
-        cursor.execute("SELECT * FROM users WHERE id = ?", (message["user"],))
-        row = cursor.fetchone()
-        if row is None:
-            update_users(conn, cursor)
+        archive_message(message)
 
     logger.debug("--------------------------")
 
 
 @app.message("")
+@job_queue.background
+@metrics.timed_handler
 def handle_message_default(message, say):
     handle_message(message, say)
 
 
 @app.event({"type": "message", "subtype": "thread_broadcast"})
+@job_queue.background
+@metrics.timed_handler
 def handle_message_thread_broadcast(event, say):
     handle_message(event, say)
 
 
+def change_message(event):
+    message = event["message"]
+    # Replaces the row instead of updating it, so the edit gets a new rowid
+    # and the next incremental export picks it up (see export.py)
+    sql = """
+        INSERT INTO messages(message, user, channel, timestamp)
+        SELECT ?, user, channel, timestamp FROM messages
+        WHERE user = ? AND channel = ? AND timestamp = ?
+    """
+    args = (message["text"], message["user"], event["channel"], message["ts"])
+    write_messages(sql, [args])
+
+
 @app.event({"type": "message", "subtype": "message_changed"})
+@job_queue.background
+@metrics.timed_handler
 def handle_message_changed(event):
-    message = event["message"]
-    conn, cursor = db_connect(database_path)
-    cursor.execute(
-        "UPDATE messages SET message = ? WHERE user = ? AND channel = ? AND timestamp = ?",
-        (message["text"], message["user"], event["channel"], message["ts"]),
-    )
-    conn.commit()
+    change_message(event)
 
 
 def init():
     # Initialize the DB if it doesn't exist
     conn, cursor = db_connect(database_path)
     migrate_db(conn, cursor)
+    if partitioned:
+        partitions.enable()
 
     # Update the users and channels in the DB and in the local memory mapping
     update_users(conn, cursor)
     update_channels(conn, cursor)
 
 
+def start_background_jobs():
+    """
+    Starts maintenance, if it's on, and resumes the interrupted backfills.
+    They need running in one process only, one that serves events: under
+    gunicorn, one of the workers (see gunicorn_conf.py), not the master.
+    """
+    if int(maintenance_interval) or backup_dir:
+        maintenance.start()
+
+    backfill.resume()
+
+
 def main():
     init()
+    start_background_jobs()
 
     # Start the development server
     app.start(port=port)
@@ -0,0 +1,278 @@
+# Serves archive bot on an asyncio event loop instead of Flask and gunicorn's
+# sync workers. The handlers are the same and share archivebot's database,
+# write queue and caches, but Slack Web API calls are awaited and SQLite reads
+# and writes run on a dedicated pool of threads, so one slow call or query
+# (or a full write queue) doesn't hold up the other events in flight.
+#
+# Usage: python async_archivebot.py
+#    or: gunicorn async_archivebot:web_app -c gunicorn_conf.py \
+#            --worker-class aiohttp.GunicornWebWorker
+
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from slack_bolt import BoltResponse
+from slack_bolt.async_app import AsyncApp
+from slack_sdk.web.async_client import AsyncWebClient
+
+import archivebot
+import metrics
+from slack_api import async_call, async_paginate
+from utils import ProcessLocal, db_connect
+
+logger = logging.getLogger(__name__)
+
+# Threads running SQLite work for the handlers
+db_workers = int(os.environ.get("ARCHIVE_BOT_DB_WORKERS", 4))
+
+app = AsyncApp(
+    token=None if archivebot.slack_api_url else os.environ.get("SLACK_BOT_TOKEN"),
+    client=(
+        AsyncWebClient(
+            token=os.environ.get("SLACK_BOT_TOKEN"),
+            base_url=archivebot.slack_api_url,
+        )
+        if archivebot.slack_api_url
+        else None
+    ),
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    logger=logger,
+)
+
+
+@app.middleware
+async def skip_redeliveries(body, next):
+    # AsyncApp acks before running handlers, but Slack may still deliver an
+    # event again, e.g. when its ack got lost. Don't handle it twice.
+    event_id = body.get("event_id")
+    if event_id and await db.run(archivebot.recent_events.add, event_id):
+        logger.info("Skipping event %s, delivered again" % event_id)
+        if metrics.enabled:
+            metrics.events_skipped.inc("duplicate")
+        return BoltResponse(status=200, body="")
+    await next()
+
+
+class Database:
+    """
+    Runs blocking SQLite work on a dedicated pool of `workers` threads, each
+    using its own pooled connection, so the event loop is never waiting on
+    the database. That includes queueing writes, which waits for room when
+    archivebot's write queue is full.
+    """
+
+    def __init__(self, database_path, workers=4):
+        self.database_path = database_path
+        self.workers = workers
+
+        self._executor = ProcessLocal(
+            lambda: ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="sqlite"
+            )
+        )
+
+    async def run(self, func, *args):
+        """
+        Returns `func(*args)`, run on one of the database threads.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor.get(), functools.partial(func, *args)
+        )
+
+    async def query(self, func, *args):
+        """
+        Returns `func(*args, cursor)`, with a cursor on the thread's
+        connection.
+        """
+        return await self.run(self._query, func, args)
+
+    def _query(self, func, args):
+        conn, cursor = db_connect(self.database_path)
+        return func(*(args + (cursor,)))
+
+
+# Reads run here, and so do archivebot's functions queueing writes
+db = Database(archivebot.database_path, db_workers)
+
+# Searches run at most --search-workers at a time, so they never take all of
+# the database threads. Any more than archivebot.SEARCH_QUEUE_SIZE waiting
+# for their turn are turned away. The semaphore belongs to the event loop
+# running the app, so it's created once that's started (see web_app).
+search_slots = None
+searches_waiting = 0
+
+
+async def get_channel_info(channel_id):
+    channel = (
+        await async_call(
+            app.client,
+            archivebot.rate_limiter,
+            "conversations.info",
+            channel=channel_id,
+        )
+    )["channel"]
+
+    # Get a list of members for the channel. This will be used when querying private channels.
+    members = []
+    if channel["is_private"]:
+        members = [
+            m
+            async for m in async_paginate(
+                app.client,
+                archivebot.rate_limiter,
+                "conversations.members",
+                "members",
+                channel=channel["id"],
+            )
+        ]
+
+    return (
+        channel["id"],
+        channel["name"],
+        channel["is_private"],
+        archivebot.channel_members(channel, members),
+    )
+
+
+@app.event("member_joined_channel")
+@metrics.timed_handler
+async def handle_join(event):
+    # If the user added is archive bot, then add the channel too, and what
+    # was said there before (backfilled on a thread of its own)
+    if event["user"] == archivebot.app._bot_user_id:
+        await db.run(
+            archivebot.add_channel, *(await get_channel_info(event["channel"]))
+        )
+        await db.run(archivebot.backfill.submit, event["channel"])
+    else:
+        await db.run(archivebot.add_member, event)
+
+
+@app.event("member_left_channel")
+@metrics.timed_handler
+async def handle_left(event):
+    await db.run(archivebot.remove_member, event)
+
+
+@app.event("channel_rename")
+@metrics.timed_handler
+async def handle_channel_rename(event):
+    await db.run(archivebot.handle_rename, event)
+
+
+@app.event("group_rename")
+@metrics.timed_handler
+async def handle_group_rename(event):
+    await db.run(archivebot.handle_rename, event)
+
+
+# Slack sends *_name events along with the *_rename ones, they need a handler
+# but there's nothing to do
+@app.event({"type": "message", "subtype": "group_name"})
+@metrics.timed_handler
+async def handle_group_name():
+    pass
+
+
+@app.event({"type": "message", "subtype": "channel_name"})
+@metrics.timed_handler
+async def handle_channel_name():
+    pass
+
+
+@app.event("user_change")
+@metrics.timed_handler
+async def handle_user_change(event):
+    await db.run(archivebot.change_user, event)
+
+
+async def handle_message(message, say):
+    logger.debug(message)
+    if "text" not in message or message["user"] == "USLACKBOT":
+        return
+
+    # If it's a DM, treat it as a search query
+    if message["channel_type"] == "im":
+        await handle_search(message, say)
+    elif "user" not in message:
+        logger.warning("No valid user. Previous event not saved")
+    else:  # Otherwise save the message to the archive.
+        await db.run(archivebot.archive_message, message)
+
+    logger.debug("--------------------------")
+
+
+async def handle_search(message, say):
+    global searches_waiting
+    if searches_waiting >= archivebot.SEARCH_QUEUE_SIZE:
+        logger.warning("Too many searches waiting, turning one away")
+        if metrics.enabled:
+            metrics.searches_limited.inc("busy")
+        await say(archivebot.BUSY_REPLY)
+        return
+
+    searches_waiting += 1
+    try:
+        await search_slots.acquire()
+    finally:
+        searches_waiting -= 1
+    try:
+        replies = await db.query(archivebot.query_replies, message)
+    finally:
+        search_slots.release()
+    for reply in replies:
+        await say(reply)
+
+
+@app.message("")
+@metrics.timed_handler
+async def handle_message_default(message, say):
+    await handle_message(message, say)
+
+
+@app.event({"type": "message", "subtype": "thread_broadcast"})
+@metrics.timed_handler
+async def handle_message_thread_broadcast(event, say):
+    await handle_message(event, say)
+
+
+@app.event({"type": "message", "subtype": "message_changed"})
+@metrics.timed_handler
+async def handle_message_changed(event):
+    await db.run(archivebot.change_message, event)
+
+
+async def metrics_endpoint(request):
+    # Only there when archive bot is recording metrics (ARCHIVE_BOT_METRICS)
+    if not metrics.enabled:
+        raise web.HTTPNotFound()
+    # The gauges query the database
+    text = await db.run(metrics.render)
+    return web.Response(
+        text=text, headers={"Content-Type": "text/plain; version=0.0.4"}
+    )
+
+
+async def create_search_slots(web_app):
+    global search_slots
+    search_slots = asyncio.Semaphore(int(archivebot.search_workers))
+
+
+web_app = app.web_app()
+web_app.router.add_get("/metrics", metrics_endpoint)
+web_app.on_startup.append(create_search_slots)
+
+
+def main():
+    archivebot.init()
+    archivebot.start_background_jobs()
+
+    web.run_app(web_app, port=int(archivebot.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# Archives what was said in a channel before archive bot joined it, by paging
+# through its history (and threads) with the Web API. archivebot starts a
+# backfill whenever it's added to a channel, and finishes interrupted ones
+# when it starts up. Channels it's already in can be backfilled on demand:
+#
+# Usage: python backfill.py [-d slack.sqlite] (--all | --channels general,random)
+
+import argparse
+import logging
+import queue
+import threading
+
+from slack_api import PAGE_SIZE, call, paginate
+from utils import ProcessLocal, db_connect
+
+logger = logging.getLogger(__name__)
+
+# Messages that are archived, by subtype. Others are joins, topic changes...
+SUBTYPES = [None, "thread_broadcast", "file_share", "me_message"]
+
+# Tells the worker thread to exit
+_STOP = object()
+
+
+def message_row(channel_id, message):
+    """
+    Returns the messages row for a message from the Web API, or None if it
+    isn't one archive bot keeps.
+    """
+    if (
+        "text" not in message
+        or "user" not in message
+        or message["user"] == "USLACKBOT"
+        or message.get("subtype") not in SUBTYPES
+    ):
+        return None
+    return (message["text"], message["user"], channel_id, message["ts"])
+
+
+class Backfill:
+    """
+    Backfills channels one at a time on a background thread, newest messages
+    first. Each page of history is queued on `write_queue` for
+    `archive(rows)` to write as soon as it's fetched, followed by the
+    timestamp of its oldest message in the backfills table, so a backfill
+    that's interrupted resumes from the last page committed.
+
+    Web API calls are made in the background (see slack_api.call), so a
+    large channel doesn't take the rate limit budget live events need.
+    """
+
+    def __init__(self, client, limiter, write_queue, archive):
+        self.client = client
+        self.limiter = limiter
+        self.write_queue = write_queue
+        self.archive = archive
+
+        self._lock = threading.Lock()
+        self._worker = ProcessLocal(self._start)
+        # Channels queued or being backfilled
+        self._pending = set()
+
+    def submit(self, channel_id, again=False):
+        """
+        Queues a channel to backfill, unless it's already queued. With
+        `again`, a channel that's been backfilled before is done again.
+        """
+        with self._lock:
+            if channel_id in self._pending:
+                return
+            self._pending.add(channel_id)
+        self._worker.get()[0].put((channel_id, again))
+
+    def resume(self):
+        """
+        Queues the backfills that were interrupted.
+        """
+        conn, cursor = db_connect(self.write_queue.database_path)
+        cursor.execute("SELECT channel FROM backfills WHERE done = 0")
+        channels = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        for channel_id in channels:
+            logger.info("Resuming backfill of %s" % channel_id)
+            self.submit(channel_id)
+
+    def close(self):
+        """
+        Waits for the queued backfills to finish.
+        """
+        if self._worker.started():
+            jobs, thread = self._worker.get()
+            jobs.put(_STOP)
+            thread.join()
+            self._worker.reset()
+
+    def backfill(self, channel_id, again=False):
+        conn, cursor = db_connect(self.write_queue.database_path)
+        cursor.execute(
+            "SELECT latest, done FROM backfills WHERE channel = ?", (channel_id,)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        latest, done = row if row and not again else (None, False)
+        if done:
+            logger.info("%s is already backfilled" % channel_id)
+            return
+
+        logger.info("Backfilling %s" % channel_id)
+        # So it's resumed if interrupted before the first page is in
+        self.write_queue.execute(
+            "INSERT OR REPLACE INTO backfills(channel, latest, done) VALUES(?,?,0)",
+            (channel_id, latest),
+        )
+        count = 0
+        while True:
+            kwargs = {"latest": latest} if latest else {}
+            response = call(
+                self.client,
+                self.limiter,
+                "conversations.history",
+                background=True,
+                channel=channel_id,
+                limit=PAGE_SIZE,
+                **kwargs,
+            )
+            rows = []
+            for message in response["messages"]:
+                row = message_row(channel_id, message)
+                if row:
+                    rows.append(row)
+                if (
+                    message.get("reply_count")
+                    and message.get("thread_ts") == message["ts"]
+                ):
+                    rows += self.replies(channel_id, message["ts"])
+
+            if response["messages"]:
+                # Pages go from newest to oldest
+                latest = response["messages"][-1]["ts"]
+            done = not response.get("has_more")
+            self.archive(rows)
+            self.write_queue.execute(
+                "INSERT OR REPLACE INTO backfills(channel, latest, done) VALUES(?,?,?)",
+                (channel_id, latest, int(done)),
+            )
+            count += len(rows)
+            if done:
+                break
+        logger.info("Backfilled %s messages in %s" % (count, channel_id))
+
+    def replies(self, channel_id, thread_ts):
+        rows = []
+        for message in paginate(
+            self.client,
+            self.limiter,
+            "conversations.replies",
+            "messages",
+            background=True,
+            channel=channel_id,
+            ts=thread_ts,
+        ):
+            # The thread's parent comes first, it's in the history already
+            row = message_row(channel_id, message)
+            if row and message["ts"] != thread_ts:
+                rows.append(row)
+        return rows
+
+    def _start(self):
+        jobs = queue.Queue()
+        thread = threading.Thread(
+            target=self._run, args=(jobs,), name="backfill", daemon=True
+        )
+        thread.start()
+        return jobs, thread
+
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is _STOP:
+                return
+            channel_id, again = job
+            try:
+                self.backfill(channel_id, again)
+            except Exception:
+                logger.exception("Backfilling %s failed" % channel_id)
+            finally:
+                with self._lock:
+                    self._pending.discard(channel_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--channels",
+        default="",
+        help=("comma-separated names or IDs of the channels to backfill"),
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help=("backfill every channel archive bot is in"),
+    )
+    parser.add_argument(
+        "--again",
+        action="store_true",
+        help=("backfill channels that were backfilled before too"),
+    )
+    # archivebot reads its own options (--database-path, --log-level...)
+    args, unknown = parser.parse_known_args()
+    if not args.channels and not args.all:
+        parser.error("name channels to backfill, or --all")
+
+    import archivebot
+
+    # Brings the users and channels up to date
+    archivebot.init()
+    archivebot.backfill.resume()
+
+    conn, cursor = db_connect(archivebot.database_path)
+    cursor.execute(
+        """
+        SELECT id, name FROM channels
+        WHERE id IN (SELECT channel FROM members WHERE user = ?)
+        """,
+        (archivebot.app._bot_user_id,),
+    )
+    channels = dict(cursor.fetchall())
+    cursor.close()
+
+    if args.all:
+        channel_ids = list(channels)
+    else:
+        names = {name: channel_id for channel_id, name in channels.items()}
+        channel_ids = []
+        for channel in args.channels.split(","):
+            channel_id = names.get(channel.lstrip("#"), channel)
+            if channel_id not in channels:
+                parser.error("archive bot isn't in %s" % channel)
+            channel_ids.append(channel_id)
+
+    for channel_id in channel_ids:
+        archivebot.backfill.submit(channel_id, again=args.again)
+    archivebot.backfill.close()
+    archivebot.write_queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,695 @@
+# Usage: python benchmark.py [-o results.json] [--messages N] ...
+# Output: JSON timings of archive bot's hot paths against a synthetic workspace
+
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BOT_USER_ID = "UBENCHBOT"
+
+# Runs a script (argv[2:]) as __main__ and, when it exits, writes its own
+# peak resident set size in KB (VmHWM) to argv[1]. The ru_maxrss wait4 gives
+# won't do: on Linux it keeps the peak of the benchmark process the script
+# was forked from, which is usually the higher one.
+PEAK_RSS_WRAPPER = """
+import atexit, runpy, sys
+
+def record_peak_rss(path=sys.argv[1]):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                with open(path, "w") as f:
+                    f.write(line.split()[1])
+
+atexit.register(record_peak_rss)
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+# Words messages are made of. Picked from with a skewed distribution so that
+# searches hit a realistic mix of common and rare words.
+WORDS = (
+    "the deploy build release fix bug test review merge branch pizza lunch "
+    "meeting standup sprint ticket server database query index cache latency "
+    "error timeout retry crash alert oncall page customer support design "
+    "frontend backend api schema migration rollback hotfix incident postmortem "
+    "docs readme question answer thanks please today tomorrow yesterday week "
+    "month quarter roadmap planning estimate budget hiring interview offer "
+    "welcome channel thread reply emoji party coffee weekend holiday"
+).split()
+
+
+def generate_workspace(
+    users=200,
+    channels=40,
+    private=0.25,
+    members_per_channel=20,
+    messages=100000,
+    days=365,
+    seed=0,
+):
+    """
+    Returns a synthetic workspace: Slack-ish user and channel objects, the
+    members of each channel and its messages, oldest first. Archive bot is a
+    member of most channels. The same arguments always give the same
+    workspace.
+    """
+    rng = random.Random(seed)
+
+    user_objects = [
+        {
+            "id": "U%06d" % i,
+            "name": "user%d" % i,
+            "profile": {
+                "display_name": "user%d" % i,
+                "image_72": "https://example.com/avatars/%d.png" % i,
+            },
+        }
+        for i in range(users)
+    ]
+    user_ids = [u["id"] for u in user_objects]
+
+    channel_objects = []
+    members = {}
+    for i in range(channels):
+        channel = {
+            "id": "C%06d" % i,
+            "name": "channel-%d" % i,
+            "is_private": rng.random() < private,
+            # Leave a few channels archive bot isn't in
+            "is_member": i % 10 != 9,
+        }
+        channel_objects.append(channel)
+        channel_members = rng.sample(user_ids, min(members_per_channel, users))
+        if channel["is_member"]:
+            channel_members.append(BOT_USER_ID)
+        members[channel["id"]] = channel_members
+
+    start = time.time() - days * 86400
+    step = days * 86400.0 / max(messages, 1)
+    message_rows = []
+    for i in range(messages):
+        channel = channel_objects[int(rng.paretovariate(1.2)) % channels]
+        text = " ".join(
+            WORDS[int(rng.paretovariate(0.8)) % len(WORDS)]
+            for _ in range(rng.randint(3, 25))
+        )
+        message_rows.append(
+            {
+                "channel": channel["id"],
+                "user": rng.choice(members[channel["id"]][:members_per_channel]),
+                "text": text,
+                "ts": "%.6f" % (start + i * step),
+            }
+        )
+
+    return {
+        "users": user_objects,
+        "channels": channel_objects,
+        "members": members,
+        "messages": message_rows,
+    }
+
+
+def write_export(workspace, directory):
+    """
+    Writes the workspace as a Slack export directory, the way import.py
+    expects it: channels.json, users.json and a <channel>/<date>.json file of
+    messages per day.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "channels.json"), "w") as f:
+        json.dump(
+            [{"id": c["id"], "name": c["name"]} for c in workspace["channels"]], f
+        )
+    with open(os.path.join(directory, "users.json"), "w") as f:
+        json.dump(workspace["users"], f)
+
+    names = dict((c["id"], c["name"]) for c in workspace["channels"])
+    days = {}
+    for m in workspace["messages"]:
+        day = datetime.datetime.fromtimestamp(int(float(m["ts"]))).strftime("%Y-%m-%d")
+        days.setdefault((names[m["channel"]], day), []).append(
+            {"type": "message", "user": m["user"], "text": m["text"], "ts": m["ts"]}
+        )
+    for (name, day), messages in days.items():
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        with open(os.path.join(directory, name, "%s.json" % day), "w") as f:
+            json.dump(messages, f)
+
+
+class FakeSlackAPI:
+    """
+    A local stand-in for the Slack Web API methods archive bot calls, serving
+    a synthetic workspace. Point archive bot at `url` with
+    ARCHIVE_BOT_SLACK_API_URL. Counts the calls made to each method.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._users = dict((u["id"], u) for u in workspace["users"])
+        self._channels = dict((c["id"], c) for c in workspace["channels"])
+        # Each channel's messages, oldest first, and their timestamps to
+        # find where a page of history starts
+        self._history = dict((c["id"], []) for c in workspace["channels"])
+        for m in workspace["messages"]:
+            self._history[m["channel"]].append(
+                {"type": "message", "user": m["user"], "text": m["text"], "ts": m["ts"]}
+            )
+        self._history_ts = dict(
+            (channel_id, [float(m["ts"]) for m in messages])
+            for channel_id, messages in self._history.items()
+        )
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(urllib.parse.urlsplit(self.path).query)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf8")
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = dict(urllib.parse.parse_qsl(body))
+                self.respond(urllib.parse.urlsplit(self.path).query, params)
+
+            def respond(self, query, params=None):
+                params = dict(urllib.parse.parse_qsl(query), **(params or {}))
+                method = urllib.parse.urlsplit(self.path).path.rsplit("/", 1)[-1]
+                body = json.dumps(api.handle(method, params)).encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s/api/" % self.server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, params):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "auth.test":
+            return {"ok": True, "user_id": BOT_USER_ID}
+        if method == "users.list":
+            return self._page(params, "members", self.workspace["users"])
+        if method == "users.info":
+            user = self._users.get(params.get("user"))
+            if user is None:
+                return {"ok": False, "error": "user_not_found"}
+            return {"ok": True, "user": user}
+        if method == "conversations.list":
+            return self._page(params, "channels", self.workspace["channels"])
+        if method == "conversations.info":
+            channel = self._channels.get(params.get("channel"))
+            if channel is None:
+                return {"ok": False, "error": "channel_not_found"}
+            return {"ok": True, "channel": channel}
+        if method == "conversations.members":
+            members = self.workspace["members"].get(params.get("channel"))
+            if members is None:
+                return {"ok": False, "error": "channel_not_found"}
+            return self._page(params, "members", members)
+        if method == "conversations.history":
+            if params.get("channel") not in self._history:
+                return {"ok": False, "error": "channel_not_found"}
+            return self._history_page(params)
+        if method == "conversations.replies":
+            messages = self._history.get(params.get("channel"))
+            if messages is None:
+                return {"ok": False, "error": "channel_not_found"}
+            # The thread's parent first, then its replies
+            thread = [
+                m for m in messages if params.get("ts") in (m["ts"], m.get("thread_ts"))
+            ]
+            if not thread:
+                return {"ok": False, "error": "thread_not_found"}
+            return self._page(params, "messages", thread)
+        if method == "chat.postMessage":
+            return {
+                "ok": True,
+                "channel": params.get("channel"),
+                "ts": "%.6f" % time.time(),
+            }
+        return {"ok": False, "error": "unknown_method"}
+
+    def _history_page(self, params):
+        # Newest first, from before `latest` (and after `oldest`) if given,
+        # like Slack pages through a channel's history
+        channel_id = params["channel"]
+        timestamps = self._history_ts[channel_id]
+        end = len(timestamps)
+        if params.get("latest"):
+            end = bisect.bisect_left(timestamps, float(params["latest"]))
+        start = 0
+        if params.get("oldest"):
+            start = bisect.bisect_right(timestamps, float(params["oldest"]))
+        first = max(start, end - int(params.get("limit") or 100))
+        return {
+            "ok": True,
+            "messages": self._history[channel_id][first:end][::-1],
+            "has_more": first > start,
+            "response_metadata": {"next_cursor": ""},
+        }
+
+    def _page(self, params, key, items):
+        # Cursors are just offsets into the list
+        start = int(params.get("cursor") or 0)
+        end = start + int(params.get("limit") or 100)
+        next_cursor = str(end) if end < len(items) else ""
+        return {
+            "ok": True,
+            key: items[start:end],
+            "response_metadata": {"next_cursor": next_cursor},
+        }
+
+
+def percentiles(samples):
+    """
+    Summarises latencies in seconds as milliseconds.
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def at(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": at(0.5),
+        "p90_ms": at(0.9),
+        "p99_ms": at(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def run_script(args):
+    """
+    Runs one of the repo's scripts in a new process, returning how long it
+    took and its peak resident set size in KB.
+    """
+    # Without /proc (not Linux), ru_maxrss is the best there is
+    if not os.path.exists("/proc/self/status"):
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable] + args, cwd=HERE)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - start
+        if os.waitstatus_to_exitcode(status):
+            raise RuntimeError(
+                "%s exited with %s" % (args[0], os.waitstatus_to_exitcode(status))
+            )
+        return elapsed, usage.ru_maxrss
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        rss_path = os.path.join(temp_dir, "peak_rss")
+        start = time.monotonic()
+        process = subprocess.run(
+            [sys.executable, "-c", PEAK_RSS_WRAPPER, rss_path] + args, cwd=HERE
+        )
+        elapsed = time.monotonic() - start
+        if process.returncode:
+            raise RuntimeError("%s exited with %s" % (args[0], process.returncode))
+        with open(rss_path) as f:
+            return elapsed, int(f.read())
+
+
+def bench_import(export_dir, database_path, messages, workers):
+    logger.info("Benchmarking import.py..")
+    args = ["import.py", export_dir, "-d", database_path, "-l", "warning"]
+    if workers:
+        args += ["-w", str(workers)]
+    elapsed, rss = run_script(args)
+    return {
+        "seconds": round(elapsed, 3),
+        "messages": messages,
+        "messages_per_sec": round(messages / elapsed),
+        "peak_rss_kb": rss,
+    }
+
+
+def bench_export(database_path, archive_path, messages, workers, fmt):
+    logger.info("Benchmarking export.py..")
+    args = [
+        "export.py",
+        "-d",
+        database_path,
+        "-a",
+        archive_path,
+        "--format",
+        fmt,
+        "-l",
+        "warning",
+    ]
+    if workers:
+        args += ["-w", str(workers)]
+    results = {}
+    # The second run has nothing new to export, so it measures the cost of
+    # checking an up to date export
+    for run in ["full", "incremental"]:
+        elapsed, rss = run_script(args)
+        results[run] = {
+            "seconds": round(elapsed, 3),
+            "messages": messages if run == "full" else 0,
+            "messages_per_sec": round(messages / elapsed) if run == "full" else 0,
+            "peak_rss_kb": rss,
+        }
+    return results
+
+
+def load_archivebot(database_path, api_url):
+    """
+    Imports archivebot against the fake Web API. archivebot talks to Slack as
+    soon as it's imported, so the fake API has to be running first.
+    """
+    os.environ["ARCHIVE_BOT_DATABASE_PATH"] = database_path
+    os.environ["ARCHIVE_BOT_SLACK_API_URL"] = api_url
+    os.environ.setdefault("ARCHIVE_BOT_LOG_LEVEL", "warning")
+    os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-benchmark")
+    os.environ.setdefault("SLACK_SIGNING_SECRET", "benchmark")
+    # Keep archivebot from reading the benchmark's arguments as its own
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        import archivebot
+    finally:
+        sys.argv = argv
+    return archivebot
+
+
+def bench_init(archivebot, api):
+    logger.info("Benchmarking init()..")
+    results = {}
+    # The first sync brings the database up to date with the workspace, the
+    # second finds nothing to change
+    for run in ["first", "repeat"]:
+        api.calls.clear()
+        start = time.monotonic()
+        archivebot.init()
+        results[run] = {
+            "seconds": round(time.monotonic() - start, 3),
+            "api_calls": dict(api.calls),
+        }
+    return results
+
+
+def bench_ingest(archivebot, workspace, count, seed):
+    """
+    Archives `count` new messages through handle_message. Reports how long
+    handle_message takes to return (what Slack waits for) and the throughput
+    including committing everything to the database.
+    """
+    logger.info("Benchmarking message ingest..")
+    rng = random.Random(seed)
+    channels = [c for c in workspace["channels"] if c["is_member"]]
+    now = time.time()
+    events = []
+    for i in range(count):
+        channel = rng.choice(channels)
+        events.append(
+            {
+                "type": "message",
+                "channel_type": "group" if channel["is_private"] else "channel",
+                "channel": channel["id"],
+                "user": rng.choice(workspace["members"][channel["id"]][:-1]),
+                "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))),
+                "ts": "%.6f" % (now + i / 1000.0),
+            }
+        )
+
+    latencies = []
+    start = time.monotonic()
+    for event in events:
+        t = time.monotonic()
+        archivebot.handle_message(event, lambda text: None)
+        latencies.append(time.monotonic() - t)
+    archivebot.write_queue.flush()
+    elapsed = time.monotonic() - start
+
+    return {
+        "messages": count,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(count / elapsed),
+        "handle_message": percentiles(latencies),
+    }
+
+
+def queries(workspace, count, seed):
+    """
+    Returns `count` search DMs: a mix of plain words, phrases, prefixes,
+    operators and sort orders.
+    """
+    rng = random.Random(seed)
+    channels = [c for c in workspace["channels"] if c["is_member"]]
+    templates = [
+        lambda: rng.choice(WORDS),
+        lambda: "%s %s" % (rng.choice(WORDS), rng.choice(WORDS)),
+        lambda: '"%s %s"' % (rng.choice(WORDS), rng.choice(WORDS)),
+        lambda: "%s*" % rng.choice(WORDS)[:3],
+        lambda: "%s sort:desc" % rng.choice(WORDS),
+        lambda: "%s in:%s" % (rng.choice(WORDS), rng.choice(channels)["name"]),
+        lambda: "%s from:%s"
+        % (rng.choice(WORDS), rng.choice(workspace["users"])["name"]),
+        lambda: "in:%s sort:asc limit:50" % rng.choice(channels)["name"],
+        lambda: "%s after:%s"
+        % (
+            rng.choice(WORDS),
+            (datetime.date.today() - datetime.timedelta(days=rng.randint(1, 300))),
+        ),
+    ]
+    return [rng.choice(templates)() for _ in range(count)]
+
+
+def bench_query(archivebot, workspace, count, seed):
+    """
+    Times handle_search for `count` searches by members of the workspace, once
+    with an empty search cache and once more with the same searches cached.
+    """
+    logger.info("Benchmarking search..")
+    rng = random.Random(seed)
+    users = [u["id"] for u in workspace["users"]]
+    searches = [
+        {
+            "type": "message",
+            "channel_type": "im",
+            "channel": "D000000",
+            "user": rng.choice(users),
+            "text": text,
+            "ts": "%.6f" % time.time(),
+        }
+        for text in queries(workspace, count, seed)
+    ]
+    messages = []
+
+    results = {}
+    archivebot.search_cache = archivebot.SearchCache()
+    for run in ["uncached", "cached"]:
+        latencies = []
+        for event in searches:
+            t = time.monotonic()
+            # What a search worker runs, handle_message only queues it
+            archivebot.handle_search(event, messages.append)
+            latencies.append(time.monotonic() - t)
+        results[run] = percentiles(latencies)
+    archivebot.write_queue.flush()
+    results["cache"] = archivebot.search_cache.stats()
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks archive bot against a synthetic workspace"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help=("file to write the JSON results to (default = standard output)"),
+    )
+    parser.add_argument("--users", default=200, type=int, help="(default = 200)")
+    parser.add_argument("--channels", default=40, type=int, help="(default = 40)")
+    parser.add_argument(
+        "--private",
+        default=0.25,
+        type=float,
+        help=("fraction of channels that are private (default = 0.25)"),
+    )
+    parser.add_argument(
+        "--members-per-channel", default=20, type=int, help="(default = 20)"
+    )
+    parser.add_argument(
+        "--messages",
+        default=100000,
+        type=int,
+        help=("messages in the generated export (default = 100000)"),
+    )
+    parser.add_argument(
+        "--days",
+        default=365,
+        type=int,
+        help=("days the generated messages are spread over (default = 365)"),
+    )
+    parser.add_argument(
+        "--ingest",
+        default=5000,
+        type=int,
+        help=("messages to archive through handle_message (default = 5000)"),
+    )
+    parser.add_argument(
+        "--queries",
+        default=500,
+        type=int,
+        help=("searches to run through handle_query (default = 500)"),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=None,
+        type=int,
+        help=("workers for import.py and export.py (default = their defaults)"),
+    )
+    parser.add_argument(
+        "--format",
+        default="json",
+        help=("export.py format to benchmark (default = json)"),
+    )
+    parser.add_argument("--seed", default=0, type=int, help="(default = 0)")
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        help=(
+            "directory for the generated export, database and export output "
+            "(default = a temporary directory, removed afterwards)"
+        ),
+    )
+    parser.add_argument(
+        "-l",
+        "--log-level",
+        default="info",
+        help=("CRITICAL, ERROR, WARNING, INFO or DEBUG (default = INFO)"),
+    )
+    args = parser.parse_args()
+
+    log_level = args.log_level.upper()
+    assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
+    logging.basicConfig(level=getattr(logging, log_level))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="archivebot-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    export_dir = os.path.join(work_dir, "slack-export")
+    database_path = os.path.join(work_dir, "benchmark.sqlite")
+    archive_path = os.path.join(work_dir, "export")
+    for path in [export_dir, archive_path]:
+        shutil.rmtree(path, ignore_errors=True)
+    for path in [database_path, database_path + "-wal", database_path + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    config = dict(vars(args))
+    del config["output"], config["log_level"], config["work_dir"]
+    results = {"config": config, "environment": environment()}
+
+    try:
+        logger.info("Generating workspace..")
+        start = time.monotonic()
+        workspace = generate_workspace(
+            users=args.users,
+            channels=args.channels,
+            private=args.private,
+            members_per_channel=args.members_per_channel,
+            messages=args.messages,
+            days=args.days,
+            seed=args.seed,
+        )
+        write_export(workspace, export_dir)
+        results["generate_seconds"] = round(time.monotonic() - start, 3)
+
+        results["import"] = bench_import(
+            export_dir, database_path, args.messages, args.workers
+        )
+
+        api = FakeSlackAPI(workspace)
+        api.start()
+        try:
+            archivebot = load_archivebot(database_path, api.url)
+            results["init"] = bench_init(archivebot, api)
+            results["ingest"] = bench_ingest(
+                archivebot, workspace, args.ingest, args.seed
+            )
+            results["query"] = bench_query(
+                archivebot, workspace, args.queries, args.seed
+            )
+            archivebot.write_queue.close()
+        finally:
+            api.stop()
+        # Includes the generated workspace, which this process also holds
+        results["bot_peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        results["export"] = bench_export(
+            database_path,
+            archive_path,
+            args.messages + args.ingest,
+            args.workers,
+            args.format,
+        )
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        logger.info("Results written to %s" % args.output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
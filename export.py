@@ -4,13 +4,18 @@
 
 import argparse
 import datetime
+import gzip
+import heapq
+import itertools
 import json
 import logging
 import os
 import sqlite3
-import time
+from concurrent.futures import ProcessPoolExecutor
 
-from six import iteritems
+from partitions import month_range, partition_path
+
+logger = logging.getLogger(__name__)
 
 
 # Used in conjunction with sqlite3 to generate JSON-like format
@@ -21,152 +26,357 @@ def dict_factory(cursor, row):
     return d
 
 
-# Turns unicode into text
-def byteify(inp):
-    if isinstance(inp, dict):
-        return {byteify(key): byteify(value) for key, value in iteritems(inp)}
-    if isinstance(inp, list):
-        return [byteify(element) for element in inp]
-    if "unicode" in vars(globals()["__builtins__"]) and isinstance(inp, unicode):
-        return inp.encode("utf-8")
-    return inp
+FORMATS = ["json", "json.gz", "ndjson.gz"]
 
 
-def get_channel_name(channel_id):
-    return ENV["id_channel"].get(channel_id, "None")
+def state_file(archive_path, fmt):
+    """
+    Where the marks of incremental exports are kept, inside the export
+    directory. Each format has its own.
+    """
+    if fmt == "json":
+        return os.path.join(archive_path, ".export_state.json")
+    return os.path.join(archive_path, ".export_state.%s.json" % fmt)
 
 
 def get_date(ts):
     return datetime.datetime.fromtimestamp(int(ts)).strftime("%Y-%m-%d")
 
 
-# Uncomment time in the future if running daily (Used to export last days of messages)
-# time = time.time() - 86400 # One full day in seconds
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "-d",
-    "--database-path",
-    default="slack.sqlite",
-    help=("path to the SQLite database. (default = ./slack.sqlite)"),
-)
-parser.add_argument(
-    "-a",
-    "--archive_path",
-    default="export",
-    help=("path to export to (default ./export)"),
-)
-parser.add_argument(
-    "-l",
-    "--log-level",
-    default="debug",
-    help=("CRITICAL, ERROR, WARNING, INFO or DEBUG (default = DEBUG)"),
-)
-args = parser.parse_args()
-
-database_path = args.database_path
-archive_path = args.archive_path
-
-log_level = args.log_level.upper()
-assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
-logging.basicConfig(level=getattr(logging, log_level))
-logger = logging.getLogger(__name__)
-
-time = 0.0
-if not os.path.isdir(archive_path):
-    os.makedirs(archive_path)
-    time = 0.0  # Full export instead of day export
-
-# Uncomment if you need to export entire archive or make this choice
-# getAll = raw_input("Do you want to export all messages instead of last day?(y/N) ").lower()
-# if (getAll=='y'):
-#    time = 0.0
-
-
-# Establish connection to SQL database
-connection = sqlite3.connect(database_path)
-connection.row_factory = dict_factory
-cursor = connection.cursor()
-
-# Get channel and user data
-cursor.execute("SELECT * FROM channels")
-channels = byteify(cursor.fetchall())
-cursor.execute("SELECT * FROM users")
-users = byteify(cursor.fetchall())
-for u in users:
-    u["profile"] = {}
-    u["profile"]["image_72"] = u.pop("avatar")
-
-# Save channel and user data files to archive folder
-channel_file = os.path.join(archive_path, "channels.json")
-with open(channel_file, "w") as outfile:
-    json.dump(channels, outfile)
-    outfile.close()
-user_file = os.path.join(archive_path, "users.json")
-with open(user_file, "w") as outfile:
-    json.dump(users, outfile)
-    outfile.close()
-
-
-# Define the names associated with each channel id
-ENV = {
-    "channel_id": {},
-    "id_channel": {},
-}
-
-ENV["channel_id"] = dict([(m["name"], m["id"]) for m in channels])
-ENV["id_channel"] = dict([(m["id"], m["name"]) for m in channels])
-
-# Get all messages after given time (in seconds since the Epoch)
-command = (
-    "SELECT * FROM messages WHERE timestamp > %s ORDER BY channel, timestamp"
-) % time
-cursor.execute(command)
-results = byteify(cursor.fetchall())
-
-# Clean and store message results in Slack-ish format
-channel_msgs = dict([(c["name"], {}) for c in channels])
-for message in results:
-    message["text"] = message["message"]
-    message["ts"] = message["timestamp"]
-    message["type"] = "message"
-    message.pop("message")
-    message.pop("timestamp")
-
-    channel_name = get_channel_name(message["channel"])
-    if channel_name == "None":
-        continue
-
-    # timestamp format is #########.######
-    day = get_date(message["ts"].split(".")[0])
-    if channel_msgs[channel_name].get(day, None):
-        channel_msgs[channel_name][day].append(message)
+def export_metadata(cursor, archive_path):
+    """
+    Writes channels.json and users.json and returns the channel ID to name
+    mapping.
+    """
+    cursor.execute("SELECT * FROM channels")
+    channels = cursor.fetchall()
+    cursor.execute("SELECT * FROM users")
+    users = cursor.fetchall()
+    for u in users:
+        u["profile"] = {}
+        u["profile"]["image_72"] = u.pop("avatar")
+
+    # Save channel and user data files to archive folder
+    write_json(os.path.join(archive_path, "channels.json"), channels)
+    write_json(os.path.join(archive_path, "users.json"), users)
+
+    return dict([(m["id"], m["name"]) for m in channels])
+
+
+def iter_messages(cursor, channel_id, since, after, until):
+    """
+    Yields the messages in a channel sent after `since` (in seconds since
+    the Epoch) that were archived after the row `after` and up to the row
+    `until`, in Slack-ish format, oldest first. Rows are read from the cursor
+    as they're needed rather than all at once.
+    """
+    cursor.execute(
+        """
+        SELECT message, user, channel, timestamp FROM messages
+        WHERE channel = ? AND ts > ? AND rowid > ? AND rowid <= ? ORDER BY ts
+        """,
+        (channel_id, since, after, until),
+    )
+    for row in cursor:
+        yield {
+            "user": row["user"],
+            "channel": row["channel"],
+            "text": row["message"],
+            "ts": row["timestamp"],
+            "type": "message",
+        }
+
+
+def partition_paths(cursor, database_path, since):
+    """
+    Returns the (month, path) of each partition of a partitioned database
+    (see partitions.py) that holds messages after `since`.
+    """
+    try:
+        cursor.execute("SELECT month FROM partitions ORDER BY month")
+    except sqlite3.OperationalError:
+        # A database from before partitioning
+        return []
+    return [
+        (row["month"], partition_path(database_path, row["month"]))
+        for row in cursor.fetchall()
+        if month_range(row["month"])[1] > since
+    ]
+
+
+def read_text(file, compressed=False):
+    if not os.path.exists(file):
+        return None
+    if compressed:
+        with gzip.open(file, "rt") as infile:
+            return infile.read()
+    with open(file) as infile:
+        return infile.read()
+
+
+def write_text(file, text, compressed=False):
+    if compressed:
+        # mtime=0 keeps the output the same for the same content
+        with open(file, "wb") as outfile:
+            outfile.write(gzip.compress(text.encode("utf-8"), mtime=0))
+    else:
+        with open(file, "w") as outfile:
+            outfile.write(text)
+
+
+def write_json(file, data, merge=False, compressed=False):
+    """
+    Writes `data` to `file` as JSON, unless the file already holds exactly
+    that. With `merge`, `data` is a list of messages that's combined with the
+    messages already in the file. Returns whether the file was written.
+    """
+    existing = read_text(file, compressed)
+
+    if merge and existing is not None:
+        messages = {m["ts"]: m for m in json.loads(existing)}
+        messages.update((m["ts"], m) for m in data)
+        data = sorted(messages.values(), key=lambda m: float(m["ts"]))
+
+    output = json.dumps(data)
+    if output == existing:
+        return False
+    write_text(file, output, compressed)
+    return True
+
+
+def load_state(archive_path, fmt):
+    """
+    Returns the marks of the last export to `archive_path`: for each
+    channel, the last rowid exported from each database ("archive" or a
+    partition's month). Rowids go up in the order messages are archived in,
+    so messages archived later with an earlier timestamp (by a backfill or
+    import.py) are still exported next time. Edited messages replace their
+    row, so they get a new rowid and are exported again too. Exports from before marks were
+    rowids have the timestamp of the newest message exported instead.
+    """
+    file = state_file(archive_path, fmt)
+    if not os.path.exists(file):
+        return {}
+    with open(file) as infile:
+        return json.load(infile)
+
+
+def save_state(archive_path, fmt, state):
+    # Replace the file in one step so an interrupted export can't leave a
+    # half written state behind
+    file = state_file(archive_path, fmt)
+    with open(file + ".tmp", "w") as outfile:
+        json.dump(state, outfile)
+    os.replace(file + ".tmp", file)
+
+
+def connect(database_path):
+    connection = sqlite3.connect(database_path)
+    connection.row_factory = dict_factory
+    return connection.cursor()
+
+
+def export_channel(database_path, archive_path, fmt, channel_id, channel_name, mark):
+    """
+    Exports the messages in one channel archived since the last export's
+    `mark` (see load_state, or None to export everything). Runs in the
+    worker processes when exporting in parallel.
+
+    Returns the channel ID, whether anything was written and the channel's
+    new mark.
+    """
+    cursor = connect(database_path)
+    if isinstance(mark, str):
+        # A timestamp from an older export: continue after it this time
+        start, after = float(mark), {}
     else:
-        channel_msgs[channel_name][day] = [message]
-
-# Go to channel folder and title message collection as <date>.json
-update_count = 0
-for channel_name in channel_msgs.keys():
-    # Checks for any messages from today
-    if not channel_msgs[channel_name]:
-        continue
+        start, after = 0.0, mark or {}
+
+    # Messages from the partitions are merged with the archive database's
+    cursors = {"archive": cursor}
+    for month, path in partition_paths(cursor, database_path, start):
+        cursors[month] = connect(path)
+    # Taken before reading, messages archived meanwhile are left for next time
+    until = {}
+    for key, c in cursors.items():
+        c.execute(
+            "SELECT MAX(rowid) AS last FROM messages WHERE channel = ?", (channel_id,)
+        )
+        until[key] = c.fetchone()["last"] or 0
+    messages = heapq.merge(
+        *(
+            iter_messages(c, channel_id, start, after.get(key, 0), until[key])
+            for key, c in cursors.items()
+        ),
+        key=lambda m: float(m["ts"]),
+    )
+
+    if fmt == "ndjson.gz":
+        updated = export_ndjson(archive_path, channel_name, messages, bool(mark))
     else:
-        update_count += 1
-        logger.info("%s has been updated" % channel_name)
-
+        updated = export_days(
+            archive_path, channel_name, messages, bool(mark), fmt == "json.gz"
+        )
+
+    for c in cursors.values():
+        c.connection.close()
+    return channel_id, updated, until
+
+
+def export_days(archive_path, channel_name, messages, merge, compressed):
+    """
+    Writes `messages` to <channel name>/<date>.json files (or .json.gz),
+    merging them into any messages already exported for that day if there
+    was a previous export (`merge`). A day's file is only rewritten if it
+    changed. Each day's file is written as soon as its last message has been
+    read, so only one day is held in memory at a time.
+    """
     directory = os.path.join(archive_path, channel_name)
-    if "None" in directory:
-        logger.warning("Channel not found: %s" % channel_name)
-        continue
-
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    extension = "json.gz" if compressed else "json"
 
-    for day in channel_msgs[channel_name].keys():
-        file = os.path.join(directory, "%s.json") % day
-        with open(file, "w") as outfile:
-            json.dump(channel_msgs[channel_name][day], outfile)
-            outfile.close()
-logger.info("Updated %s channels" % update_count)
-
-connection.close()
+    updated = False
+    # timestamp format is #########.######
+    days = itertools.groupby(messages, key=lambda m: get_date(m["ts"].split(".")[0]))
+    for day, day_messages in days:
+        day_messages = list(day_messages)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        file = os.path.join(directory, "%s.%s") % (day, extension)
+        updated |= write_json(file, day_messages, merge=merge, compressed=compressed)
+
+    return updated
+
+
+def export_ndjson(archive_path, channel_name, messages, append):
+    """
+    Writes `messages` to <channel name>.ndjson.gz, one JSON message per line.
+    With `append`, they're added to the end of the file of a previous export,
+    so messages archived late (e.g. by a backfill) come after newer ones, and
+    an edited message is there again with its new text, after the old one.
+    """
+    file = os.path.join(archive_path, "%s.ndjson.gz" % channel_name)
+
+    outfile = None
+    for message in messages:
+        if outfile is None:
+            outfile = gzip.open(file, "at" if append else "wt")
+        outfile.write(json.dumps(message) + "\n")
+
+    if outfile is None:
+        return False
+    outfile.close()
+    return True
+
+
+def export_messages(database_path, archive_path, fmt, channel_names, state, workers):
+    """
+    Exports the messages archived since each channel's mark in `state` and
+    advances the marks. With more than one worker, channels are exported
+    in parallel by a pool of processes.
+    """
+    jobs = [
+        (
+            database_path,
+            archive_path,
+            fmt,
+            channel_id,
+            channel_name,
+            state.get(channel_id),
+        )
+        for channel_id, channel_name in channel_names.items()
+    ]
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(export_channel, *zip(*jobs)) if jobs else []
+    else:
+        pool = None
+        results = (export_channel(*job) for job in jobs)
+
+    updated_channels = 0
+    for channel_id, updated, mark in results:
+        state[channel_id] = mark
+        if updated:
+            updated_channels += 1
+            logger.info("%s has been updated" % channel_names[channel_id])
+
+    if pool:
+        pool.shutdown()
+    return updated_channels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--database-path",
+        default="slack.sqlite",
+        help=("path to the SQLite database. (default = ./slack.sqlite)"),
+    )
+    parser.add_argument(
+        "-a",
+        "--archive_path",
+        default="export",
+        help=("path to export to (default ./export)"),
+    )
+    parser.add_argument(
+        "-f",
+        "--full",
+        action="store_true",
+        help=(
+            "export every message again instead of only the ones archived "
+            "since the last export to this path"
+        ),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        type=int,
+        help=("number of processes exporting channels in parallel (default = 1)"),
+    )
+    parser.add_argument(
+        "--format",
+        default="json",
+        choices=FORMATS,
+        help=(
+            "json: a <channel>/<date>.json file per day, like a Slack export. "
+            "json.gz: the same, gzipped. ndjson.gz: a gzipped <channel>.ndjson.gz "
+            "file per channel with one message per line. (default = json)"
+        ),
+    )
+    parser.add_argument(
+        "-l",
+        "--log-level",
+        default="debug",
+        help=("CRITICAL, ERROR, WARNING, INFO or DEBUG (default = DEBUG)"),
+    )
+    args = parser.parse_args()
+
+    database_path = args.database_path
+    archive_path = args.archive_path
+
+    log_level = args.log_level.upper()
+    assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
+    logging.basicConfig(level=getattr(logging, log_level))
+
+    if not os.path.isdir(archive_path):
+        os.makedirs(archive_path)
+
+    # Only export what's new since the last export, unless asked not to
+    state = {} if args.full else load_state(archive_path, args.format)
+
+    # Establish connection to SQL database
+    cursor = connect(database_path)
+    channel_names = export_metadata(cursor, archive_path)
+    cursor.connection.close()
+
+    update_count = export_messages(
+        database_path, archive_path, args.format, channel_names, state, args.workers
+    )
+    save_state(archive_path, args.format, state)
+    logger.info("Updated %s channels" % update_count)
+
+
+if __name__ == "__main__":
+    main()
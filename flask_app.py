@@ -1,6 +1,7 @@
-from flask import Flask, request
+from flask import Flask, Response, abort, request
 from slack_bolt.adapter.flask import SlackRequestHandler
 
+import metrics
 from archivebot import app
 
 flask_app = Flask(__name__)
@@ -10,3 +11,11 @@ handler = SlackRequestHandler(app)
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events():
     return handler.handle(request)
+
+
+@flask_app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # Only there when archive bot is recording metrics (ARCHIVE_BOT_METRICS)
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
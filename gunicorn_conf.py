@@ -1,5 +1,40 @@
-from archivebot import init
+import fcntl
+
+from archivebot import (
+    database_path,
+    init,
+    job_queue,
+    start_background_jobs,
+    write_queue,
+)
+from utils import close_connections
+
+# Held by the worker running maintenance and backfills
+background_lock = None
 
 
 def on_starting(server):
     init()
+
+
+def post_worker_init(worker):
+    # Maintenance and backfills run in the first worker to take the lock, and
+    # in the one started after it exits. Not in the master: it forks workers
+    # whenever one restarts, and its threads could be in SQLite when it does
+    # (nor would any worker serve their metrics).
+    global background_lock
+    lock = open(database_path + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return
+    background_lock = lock
+    start_background_jobs()
+
+
+def worker_exit(server, worker):
+    # Handle the events already acked before committing the last writes
+    job_queue.close()
+    write_queue.close()
+    close_connections()
@@ -1,82 +1,380 @@
 import argparse
+import collections
 import glob
+import hashlib
 import json
 import logging
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-from utils import db_connect, migrate_db
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("directory", help=("path to the downloaded Slack archive"))
-parser.add_argument(
-    "-d",
-    "--database-path",
-    default="slack.sqlite",
-    help=("path to the SQLite database. (default = ./slack.sqlite)"),
-)
-parser.add_argument(
-    "-l",
-    "--log-level",
-    default="debug",
-    help=("CRITICAL, ERROR, WARNING, INFO or DEBUG (default = DEBUG)"),
+from partitions import Partitions
+from utils import (
+    db_connect,
+    drop_message_indexes,
+    message_indexes_dropped,
+    migrate_db,
+    rebuild_message_indexes,
+    sync_rows,
 )
-args = parser.parse_args()
 
-log_level = args.log_level.upper()
-assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
-logging.basicConfig(level=getattr(logging, log_level))
 logger = logging.getLogger(__name__)
 
-conn, cursor = db_connect(args.database_path)
-migrate_db(conn, cursor)
-
-directory = args.directory
-
-logger.info("Importing channels..")
-with open(os.path.join(directory, "channels.json")) as f:
-    channels = json.load(f)
-args = [(c["name"], c["id"], 1) for c in channels]
-cursor.executemany("INSERT INTO channels VALUES(?,?,?)", (args))
-logger.info("- Channels imported")
-
-logger.info("Importing users..")
-with open(os.path.join(directory, "users.json")) as f:
-    users = json.load(f)
-args = [(u["name"], u["id"], u["profile"]["image_72"]) for u in users]
-cursor.executemany("INSERT INTO users VALUES(?,?,?)", (args))
-logger.info("- Users imported")
-
-logger.info("Importing messages..")
-for channel in channels:
-    files = glob.glob(os.path.join(directory, channel["name"], "*.json"))
-    if not files:
-        logger.warning("No messages found for #%s" % channel["name"])
-    for file_name in files:
-        with open(file_name, encoding="utf8") as f:
-            messages = json.load(f)
-
-        args = []
-        for message in messages:
-            if "id" in channel and "ts" in message:
-                args.append(
-                    (
-                        message["text"]
-                        if "text" in message
-                        else "~~There is a message ommitted here~~",
-                        message["user"] if "user" in message else "",
-                        channel["id"],
-                        message["ts"],
-                    )
+# How often to log progress, in seconds
+PROGRESS_INTERVAL = 10
+
+
+def parse_file(directory, path, channel_id, known_sha1):
+    """
+    Reads one <channel>/<date>.json export file and returns its path, its
+    SHA-1 and its messages rows. If the file's content hasn't changed since
+    it was imported (its SHA-1 is `known_sha1`), returns None for the rows
+    instead of parsing it. Runs in the parser processes.
+    """
+    with open(os.path.join(directory, path), "rb") as f:
+        content = f.read()
+    sha1 = hashlib.sha1(content).hexdigest()
+    if sha1 == known_sha1:
+        return path, sha1, None
+    messages = json.loads(content.decode("utf8"))
+
+    args = []
+    for message in messages:
+        if channel_id is not None and "ts" in message:
+            args.append(
+                (
+                    message["text"]
+                    if "text" in message
+                    else "~~There is a message ommitted here~~",
+                    message["user"] if "user" in message else "",
+                    channel_id,
+                    message["ts"],
                 )
-            else:
-                logger.warning(
-                    "In "
-                    + file_name
-                    + ": An exception occured, message not added to archive."
+            )
+        else:
+            logger.warning(
+                "In " + path + ": An exception occured, message not added to archive."
+            )
+    return path, sha1, args
+
+
+def parse_files(directory, files, workers):
+    """
+    Parses `files` (tuples of parse_file's arguments after the directory) on a
+    pool of processes and yields the results in order. Only a few files per worker are parsed ahead
+    of the caller, so memory use doesn't grow with the size of the archive.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        files = iter(files)
+        for file in files:
+            pending.append(pool.submit(parse_file, directory, *file))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def apply_diff(cursor, channel_id, args):
+    """
+    Applies a file's messages rows to the database, inserting the messages
+    that are new and updating the ones whose text or user changed. Messages
+    that are already there unchanged aren't touched. Returns the number of
+    messages inserted and updated.
+    """
+    cursor.execute(
+        """
+        SELECT timestamp, message, user FROM messages
+        WHERE channel = ? AND timestamp IN (SELECT value FROM json_each(?))
+        """,
+        (channel_id, json.dumps([row[3] for row in args])),
+    )
+    existing = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    inserts = [row for row in args if row[3] not in existing]
+    updates = [
+        row
+        for row in args
+        if row[3] in existing and existing[row[3]] != (row[0], row[1])
+    ]
+    # Changed messages replace the old row (see the messages table's UNIQUE
+    # constraint) rather than update it, so they get a new rowid and the
+    # next incremental export picks them up (see export.py)
+    cursor.executemany("INSERT INTO messages VALUES(?, ?, ?, ?)", inserts + updates)
+    return len(inserts), len(updates)
+
+
+def write_messages(cursor, channel_id, args, diff):
+    if diff:
+        return apply_diff(cursor, channel_id, args)
+    cursor.executemany("INSERT INTO messages VALUES(?, ?, ?, ?)", args)
+    return len(args), 0
+
+
+def import_messages(
+    conn, cursor, directory, channels, workers, batch_size, diff, partitions=None
+):
+    """
+    Imports the messages of every export file that's new or changed since it
+    was last imported. Files whose size and modification time are unchanged
+    aren't read at all, and files whose content hash is unchanged aren't
+    parsed. With `diff`, only messages that are new or changed are written,
+    otherwise every message is inserted.
+
+    Parsed files are written about `batch_size` messages at a time, each
+    batch in a transaction of its own, so the write lock is only held while
+    writing and the bot can commit new messages in between.
+
+    With `partitions`, messages go to the partition of their month instead
+    of the archive database, unless they're older than partitioning (see
+    Partitions.month).
+    """
+    cursor.execute("SELECT path, size, mtime, sha1 FROM imported_files")
+    imported = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    files = []
+    stats = {}
+    unchanged = 0
+    for channel in channels:
+        paths = glob.glob(os.path.join(directory, channel["name"], "*.json"))
+        if not paths:
+            logger.warning("No messages found for #%s" % channel["name"])
+        for path in sorted(paths):
+            stat = os.stat(path)
+            path = os.path.relpath(path, directory)
+            size, mtime, sha1 = imported.get(path, (None, None, None))
+            if (size, mtime) == (stat.st_size, stat.st_mtime):
+                unchanged += 1
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime)
+            files.append((path, channel.get("id"), sha1))
+    logger.info("%s files to check, %s unchanged" % (len(files), unchanged))
+
+    channel_ids = dict((path, channel_id) for path, channel_id, _ in files)
+
+    # Connections to the partitions written so far
+    opened = {}
+
+    def partition_cursor(month):
+        path = partitions.path(month)
+        if path not in opened:
+            opened[path] = partitions.connect(path)
+            opened[path][1].execute("SELECT 1 FROM messages LIMIT 1")
+            if opened[path][1].fetchone() is None:
+                # See main()
+                opened[path][1].execute("PRAGMA synchronous = OFF")
+            partitions.register(cursor, month)
+        return opened[path][1]
+
+    def commit():
+        # Partitions first, so the manifest never lists a file whose messages
+        # weren't committed
+        for partition_conn, _ in opened.values():
+            partition_conn.commit()
+        if partitions is not None:
+            # The triggers keeping the generation for the bot's search cache
+            # don't see the partitions
+            cursor.execute("UPDATE generation SET value = value + 1")
+        conn.commit()
+
+    def write_files(parsed):
+        # Writes a batch of parsed files, returns the number of messages
+        # inserted and updated
+        inserted = changed = 0
+        for path, sha1, args in parsed:
+            if args is None:
+                # Only touched, the content is what was imported before
+                cursor.execute(
+                    "UPDATE imported_files SET size = ?, mtime = ? WHERE path = ?",
+                    stats[path] + (path,),
                 )
+                continue
+
+            if partitions is None:
+                counts = write_messages(cursor, channel_ids[path], args, diff)
+                inserted += counts[0]
+                changed += counts[1]
+            else:
+                months = collections.defaultdict(list)
+                for row in args:
+                    months[partitions.month(row[3])].append(row)
+                for month, rows in months.items():
+                    # None for the archive database (see Partitions.month)
+                    counts = write_messages(
+                        cursor if month is None else partition_cursor(month),
+                        channel_ids[path],
+                        rows,
+                        diff,
+                    )
+                    inserted += counts[0]
+                    changed += counts[1]
+
+            # Recorded in the same transaction as the file's messages, so a
+            # re-run skips exactly the files that made it into the database
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO imported_files(path, messages, size, mtime, sha1)
+                VALUES(?,?,?,?,?)
+                """,
+                (path, len(args)) + stats[path] + (sha1,),
+            )
+        commit()
+        return inserted, changed
+
+    count = 0
+    updated = 0
+    parsed = []
+    pending = 0
+    start = last_report = time.monotonic()
+    for n, result in enumerate(parse_files(directory, files, workers), 1):
+        parsed.append(result)
+        pending += len(result[2] or ())
+        if pending >= batch_size:
+            inserted, changed = write_files(parsed)
+            count += inserted
+            updated += changed
+            parsed = []
+            pending = 0
+
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            logger.info(
+                "- %s/%s files, %s messages (%.0f messages/sec)"
+                % (n, len(files), count, count / (now - start))
+            )
+            last_report = now
+    inserted, changed = write_files(parsed)
+    count += inserted
+    updated += changed
+    for _, partition_cursor in opened.values():
+        partition_cursor.execute("PRAGMA synchronous = NORMAL")
+
+    elapsed = time.monotonic() - start
+    logger.info(
+        "- %s messages imported, %s updated in %.1fs (%.0f messages/sec)"
+        % (count, updated, elapsed, count / elapsed if elapsed else 0)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help=("path to the downloaded Slack archive"))
+    parser.add_argument(
+        "-d",
+        "--database-path",
+        default="slack.sqlite",
+        help=("path to the SQLite database. (default = ./slack.sqlite)"),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=os.cpu_count(),
+        type=int,
+        help=("number of processes parsing files (default = number of CPUs)"),
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        default=5000,
+        type=int,
+        help=("messages to insert per transaction (default = 5000)"),
+    )
+    parser.add_argument(
+        "-l",
+        "--log-level",
+        default="debug",
+        help=("CRITICAL, ERROR, WARNING, INFO or DEBUG (default = DEBUG)"),
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help=(
+            "import messages into one database per month (see partitions.py). "
+            "Always on for a database that's already partitioned."
+        ),
+    )
+    args = parser.parse_args()
+
+    log_level = args.log_level.upper()
+    assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
+    logging.basicConfig(level=getattr(logging, log_level))
 
-        cursor.executemany("INSERT INTO messages VALUES(?, ?, ?, ?)", args)
+    conn, cursor = db_connect(args.database_path)
+    migrate_db(conn, cursor)
+
+    # Without syncing, a power loss or OS crash halfway through can corrupt
+    # the database, not just lose the last batches. Only worth it for a new
+    # database, which can be deleted and imported again; one that's already
+    # archiving messages is imported into safely.
+    cursor.execute("SELECT 1 FROM messages LIMIT 1")
+    empty = cursor.fetchone() is None
+    if empty:
+        cursor.execute("PRAGMA synchronous = OFF")
+
+    directory = args.directory
+
+    # Only write the channels and users that are new or changed: every write
+    # to them starts the search cache over
+    logger.info("Importing channels..")
+    with open(os.path.join(directory, "channels.json")) as f:
+        channels = json.load(f)
+    # Channels archive bot already knows keep whether they're private, which
+    # it knows better than the export. New ones are private until it finds
+    # out, so only their members can search them.
+    cursor.execute("SELECT id, is_private FROM channels")
+    is_private = dict(cursor.fetchall())
+    rows = [(c["id"], c["name"], is_private.get(c["id"], 1)) for c in channels]
+    counts = sync_rows(
+        cursor, "channels", ("id",), ("name", "is_private"), rows, delete=False
+    )
+    logger.info("- Channels: %s added, %s changed, %s removed" % counts)
+
+    logger.info("Importing users..")
+    with open(os.path.join(directory, "users.json")) as f:
+        users = json.load(f)
+    rows = [(u["id"], u["name"], u["profile"]["image_72"]) for u in users]
+    counts = sync_rows(cursor, "users", ("id",), ("name", "avatar"), rows, delete=False)
+    conn.commit()
+    logger.info("- Users: %s added, %s changed, %s removed" % counts)
+
+    partitions = Partitions(args.database_path)
+    if args.partitioned and not partitions.enabled():
+        partitions.enable()
+    partitioned = partitions.enabled()
+    if partitioned:
+        logger.info("Importing into monthly partitions")
+
+    # Loading into an empty database is much faster without keeping the
+    # indexes up to date on every insert, so build them once at the end. A
+    # previous import that was interrupted may already have dropped them.
+    # Partitions keep their indexes.
+    deferred = not partitioned and (empty or message_indexes_dropped(cursor))
+    if deferred:
+        logger.info("Deferring index builds until the import is done")
+        drop_message_indexes(cursor)
         conn.commit()
-logger.info("- Messages imported")
-logger.info("Done")
+
+    logger.info("Importing messages..")
+    import_messages(
+        conn,
+        cursor,
+        directory,
+        channels,
+        args.workers,
+        args.batch_size,
+        diff=not deferred,
+        partitions=partitions if partitioned else None,
+    )
+
+    if deferred:
+        logger.info("Building indexes..")
+        rebuild_message_indexes(cursor)
+        conn.commit()
+        logger.info("- Indexes built")
+
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    logger.info("Done")
+
+
+if __name__ == "__main__":
+    main()
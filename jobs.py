@@ -0,0 +1,151 @@
+import functools
+import inspect
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from utils import ProcessLocal, db_connect
+
+logger = logging.getLogger(__name__)
+
+# Tells a worker thread to exit
+_STOP = object()
+
+
+class JobQueue:
+    """
+    Runs event handlers on background worker threads, so the HTTP request
+    from Slack can be acked as soon as the event is queued instead of after
+    Slack API calls and database work. Slack expects an ack within 3 seconds
+    and sends the event again if it doesn't get one.
+
+    At most `max_size` jobs wait in the queue; `full` tells the caller to
+    turn events away until the workers catch up. `close` runs everything
+    already queued before returning. Worker threads are named after `name`.
+    """
+
+    def __init__(self, workers=4, max_size=1000, name="event-worker"):
+        self.workers = workers
+        self.max_size = max_size
+        self.name = name
+
+        self._pool = ProcessLocal(self._start)
+        self._closed = False
+
+    def background(self, func):
+        """
+        Decorates a Bolt handler so calling it queues the call to run on a
+        worker. Keeps the handler's signature, Bolt passes handlers the
+        arguments they name.
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.submit(func, *args, **kwargs)
+
+        wrapper.__signature__ = inspect.signature(func)
+        return wrapper
+
+    def submit(self, func, *args, **kwargs):
+        if self._closed:
+            # Shutting down, nothing will pick it up so do it now
+            self._run_job(func, args, kwargs)
+            return
+        job_queue, _ = self._pool.get()
+        job_queue.put((func, args, kwargs))
+
+    def full(self):
+        return self.depth() >= self.max_size
+
+    def depth(self):
+        return self._pool.get()[0].qsize() if self._pool.started() else 0
+
+    def close(self):
+        """
+        Stops taking jobs and waits for the queued ones to finish.
+        """
+        self._closed = True
+        if self._pool.started():
+            job_queue, threads = self._pool.get()
+            for _ in threads:
+                job_queue.put(_STOP)
+            for thread in threads:
+                thread.join()
+            self._pool.reset()
+
+    def _start(self):
+        # No bound here, callers check `full` before queueing
+        job_queue = queue.Queue()
+        threads = [
+            threading.Thread(
+                target=self._work,
+                args=(job_queue,),
+                name="%s-%s" % (self.name, i),
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        return job_queue, threads
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+            if job is _STOP:
+                return
+            self._run_job(*job)
+
+    def _run_job(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Handling an event with %s failed" % func.__name__)
+
+
+class RecentEvents:
+    """
+    Remembers the IDs of the events accepted in the last `ttl` seconds, so
+    events Slack delivers again can be skipped. Slack retries an event three
+    times over about five minutes. They're kept in the database, so a retry
+    is skipped whichever gunicorn worker it reaches. Expired ones are deleted
+    every `sweep_interval` seconds.
+    """
+
+    def __init__(self, database_path, ttl=3600, sweep_interval=60):
+        self.database_path = database_path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+
+        self._next_sweep = 0
+
+    def add(self, event_id):
+        """
+        Records `event_id` and returns False, or returns True if it was
+        already recorded.
+        """
+        now = time.time()
+        conn, cursor = db_connect(self.database_path)
+        try:
+            # An expired ID is recorded again, as a new event
+            cursor.execute(
+                """
+                INSERT INTO recent_events(id, expires) VALUES(?, ?)
+                ON CONFLICT(id) DO UPDATE SET expires = excluded.expires
+                WHERE recent_events.expires <= ?
+                """,
+                (event_id, now + self.ttl, now),
+            )
+            recorded = cursor.rowcount == 0
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                cursor.execute("DELETE FROM recent_events WHERE expires <= ?", (now,))
+            conn.commit()
+        except sqlite3.Error:
+            # Better to handle an event twice than not at all
+            logger.exception("Recording event %s failed" % event_id)
+            conn.rollback()
+            return False
+        return recorded
@@ -0,0 +1,359 @@
+# Keeps the archive database (and its partitions) in shape while the bot is
+# running: checkpoints the WAL, refreshes the query planner's statistics,
+# gives free pages back to the filesystem and takes online backups.
+#
+# archivebot runs it on a background thread (see --maintenance-interval and
+# --backup-dir). It can also be run on its own, e.g. from cron:
+#
+# Usage: python maintenance.py -d slack.sqlite --backup-dir backups
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from partitions import Partitions
+from utils import ProcessLocal, db_connect
+
+logger = logging.getLogger(__name__)
+
+# Pages copied per backup step, and the pause before retrying a step that
+# found the database busy or locked (Connection.backup doesn't pause between
+# steps otherwise). The writer isn't held up either way: the backup only
+# reads, from a snapshot, which in WAL mode doesn't block commits.
+BACKUP_STEP_PAGES = 1000
+BACKUP_BUSY_SLEEP = 0.01
+# Free pages given back per incremental vacuum transaction
+VACUUM_STEP_PAGES = 1000
+# Rows ANALYZE looks at per index, to keep it quick on large tables
+ANALYSIS_LIMIT = 1000
+
+# What wal_checkpoint last reported for each database: the pages in its WAL
+# and how many of them have been copied, counting earlier checkpoints
+_wal_pages = {}
+
+
+def checkpoint(conn, cursor):
+    """
+    Copies the WAL into the database file so it can be reused from the start
+    (and truncated to utils.JOURNAL_SIZE_LIMIT). PASSIVE doesn't wait for
+    readers or the writer, whatever they still need is left for next time.
+    Returns the number of pages copied, since the last checkpoint of the
+    database in this process.
+    """
+    cursor.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    busy, log, checkpointed = cursor.fetchone()
+    cursor.execute("PRAGMA database_list")
+    path = cursor.fetchone()[2]
+
+    last_log, last_checkpointed = _wal_pages.get(path, (0, 0))
+    _wal_pages[path] = (log, checkpointed)
+    # Less than last time: the WAL has been started over since, and
+    # everything in it is new
+    if log < last_log or checkpointed < last_checkpointed:
+        last_checkpointed = 0
+    return max(checkpointed - last_checkpointed, 0)
+
+
+def optimize(conn, cursor):
+    """
+    Refreshes the statistics the query planner uses to pick indexes.
+    """
+    cursor.execute("PRAGMA analysis_limit = %d" % ANALYSIS_LIMIT)
+    if sqlite3.sqlite_version_info >= (3, 46, 0):
+        # Only analyzes the tables that changed enough since the last time
+        cursor.execute("PRAGMA optimize = 0x10002")
+    else:
+        # Older versions only optimize tables this connection has queried
+        cursor.execute("ANALYZE")
+    conn.commit()
+    return 0
+
+
+def vacuum(conn, cursor):
+    """
+    Gives free pages back to the filesystem, VACUUM_STEP_PAGES per
+    transaction. Returns the number of pages freed, or None for databases
+    created before incremental vacuum was turned on (see `convert`). A full
+    VACUUM isn't an option here: it holds the write lock until it's done and
+    may renumber the messages' rowids, which messages_fts refers to.
+    """
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] != 2:
+        return None
+
+    freed = 0
+    while True:
+        cursor.execute("PRAGMA freelist_count")
+        free = cursor.fetchone()[0]
+        if free == 0:
+            return freed
+        # Each step of the statement frees one page
+        cursor.execute("PRAGMA incremental_vacuum(%d)" % VACUUM_STEP_PAGES)
+        cursor.fetchall()
+        conn.commit()
+        freed += min(free, VACUUM_STEP_PAGES)
+
+
+def convert(conn, cursor):
+    """
+    Turns incremental vacuum on for a database created before it was, with
+    a full VACUUM, then rebuilds messages_fts in case the VACUUM renumbered
+    the messages' rowids (incremental exports go by rowid too, so export
+    with --full afterwards). Holds the write lock throughout, so it's meant
+    to be run with archive bot stopped. Returns the database's size in pages,
+    or None if incremental vacuum was on already.
+    """
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] == 2:
+        return None
+
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("VACUUM")
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )
+    if cursor.fetchone():
+        cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        conn.commit()
+    cursor.execute("PRAGMA page_count")
+    return cursor.fetchone()[0]
+
+
+# The jobs run every `interval`, backups have a schedule of their own
+UPKEEP = {"checkpoint": checkpoint, "optimize": optimize, "vacuum": vacuum}
+JOBS = list(UPKEEP) + ["backup"]
+
+
+def backup(conn, cursor, backup_path):
+    """
+    Copies the database to `backup_path` while the writer carries on
+    committing. Returns the number of pages copied.
+    """
+    # Written next to the backup and moved over it once complete, so there's
+    # always a whole backup
+    temp_path = backup_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    target = sqlite3.connect(temp_path)
+
+    # Copy from a snapshot. Otherwise every commit made while the backup runs
+    # starts it over from the first page, and under steady ingest it never
+    # finishes. Checkpoints can't go past the snapshot until it's done.
+    copied = []
+    cursor.execute("BEGIN")
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+    cursor.fetchall()
+    try:
+        conn.backup(
+            target,
+            pages=BACKUP_STEP_PAGES,
+            progress=lambda status, remaining, total: copied.append(total),
+            sleep=BACKUP_BUSY_SLEEP,
+        )
+    finally:
+        conn.rollback()
+        target.close()
+    os.replace(temp_path, backup_path)
+    return copied[-1] if copied else 0
+
+
+class Maintenance:
+    """
+    Runs the maintenance jobs on every database returned by `paths`: the
+    checkpoint, optimize and vacuum jobs every `interval` seconds and, with
+    a `backup_dir`, backups every `backup_interval` seconds. Each backup
+    replaces the previous one of the same database.
+    """
+
+    def __init__(self, paths, interval=900, backup_dir=None, backup_interval=86400):
+        self.paths = paths
+        self.interval = interval
+        self.backup_dir = backup_dir
+        self.backup_interval = backup_interval
+
+        self._thread = ProcessLocal(self._start)
+
+    def run(self, jobs):
+        """
+        Runs `jobs` on every database now. Returns a report of each job that
+        ran: the job, the database, the seconds taken and the pages it
+        checkpointed, freed or copied.
+        """
+        if "backup" in jobs and self.backup_dir and not os.path.isdir(self.backup_dir):
+            os.makedirs(self.backup_dir)
+
+        reports = []
+        for path in self.paths():
+            conn, cursor = db_connect(path)
+            for job in jobs:
+                start = time.perf_counter()
+                try:
+                    if job == "backup":
+                        if not self.backup_dir:
+                            continue
+                        pages = backup(
+                            conn,
+                            cursor,
+                            os.path.join(self.backup_dir, os.path.basename(path)),
+                        )
+                    else:
+                        pages = UPKEEP[job](conn, cursor)
+                except (sqlite3.Error, OSError):
+                    logger.exception("Maintenance job %s failed on %s" % (job, path))
+                    continue
+                seconds = time.perf_counter() - start
+                if pages is None:
+                    logger.debug("Nothing for %s to do on %s" % (job, path))
+                    continue
+
+                # Idle databases would fill the log otherwise
+                log = logger.info if pages or job == "backup" else logger.debug
+                log("%s of %s: %s pages in %.2fs" % (job, path, pages, seconds))
+                if metrics.enabled:
+                    metrics.maintenance_seconds.observe(job, seconds)
+                    metrics.maintenance_pages.inc(job, pages)
+                reports.append(
+                    {"job": job, "database": path, "seconds": seconds, "pages": pages}
+                )
+            cursor.close()
+        return reports
+
+    def run_forever(self, jobs=JOBS):
+        """
+        Runs `jobs` on their schedules until the process exits.
+        """
+        upkeep = [job for job in jobs if job in UPKEEP]
+        due = {}
+        if upkeep and self.interval:
+            due["upkeep"] = time.monotonic() + self.interval
+        if self.backup_dir and "backup" in jobs:
+            due["backup"] = time.monotonic() + self.backup_interval
+
+        while due:
+            time.sleep(max(0, min(due.values()) - time.monotonic()))
+            now = time.monotonic()
+            if due.get("upkeep", now + 1) <= now:
+                self.run(upkeep)
+                due["upkeep"] = now + self.interval
+            if due.get("backup", now + 1) <= now:
+                self.run(["backup"])
+                due["backup"] = now + self.backup_interval
+
+    def start(self):
+        """
+        Runs the jobs on a background thread, unless it's already running in
+        this process.
+        """
+        self._thread.get()
+
+    def _start(self):
+        thread = threading.Thread(
+            target=self.run_forever, name="maintenance", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+def database_paths(partitions):
+    """
+    Returns a function listing the archive database and its partitions.
+    """
+    return lambda: (
+        partitions.paths() if partitions.enabled() else [partitions.database_path]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--database-path",
+        default="slack.sqlite",
+        help=("path to the SQLite database. (default = ./slack.sqlite)"),
+    )
+    parser.add_argument(
+        "-b",
+        "--backup-dir",
+        help=("directory to back the database up to (default = no backups)"),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=",".join(JOBS),
+        help=("comma-separated jobs to run (default = %s)" % ",".join(JOBS)),
+    )
+    parser.add_argument(
+        "-i",
+        "--interval",
+        type=int,
+        help=(
+            "keep running, with the backup job every --backup-interval "
+            "seconds and the others every INTERVAL seconds (default = run "
+            "once and exit)"
+        ),
+    )
+    parser.add_argument(
+        "--backup-interval",
+        default=86400,
+        type=int,
+        help=("seconds between backups with --interval (default = 86400)"),
+    )
+    parser.add_argument(
+        "--convert",
+        action="store_true",
+        help=(
+            "turn incremental vacuum on for databases created before it was "
+            "the default, with a full VACUUM of each, and exit. Stop archive "
+            "bot first: it can't write until this is done."
+        ),
+    )
+    parser.add_argument(
+        "-l",
+        "--log-level",
+        default="info",
+        help=("CRITICAL, ERROR, WARNING, INFO or DEBUG (default = INFO)"),
+    )
+    args = parser.parse_args()
+
+    log_level = args.log_level.upper()
+    assert log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
+    logging.basicConfig(level=getattr(logging, log_level))
+
+    jobs = args.jobs.split(",")
+    for job in jobs:
+        if job not in JOBS:
+            parser.error("unknown job %s" % job)
+
+    if args.convert:
+        for path in database_paths(Partitions(args.database_path))():
+            conn, cursor = db_connect(path)
+            start = time.perf_counter()
+            pages = convert(conn, cursor)
+            cursor.close()
+            if pages is None:
+                logger.info("Incremental vacuum is on already for %s" % path)
+            else:
+                logger.info(
+                    "Converted %s: %s pages in %.2fs"
+                    % (path, pages, time.perf_counter() - start)
+                )
+        return
+
+    maintenance = Maintenance(
+        database_paths(Partitions(args.database_path)),
+        interval=args.interval,
+        backup_dir=args.backup_dir,
+        backup_interval=args.backup_interval,
+    )
+    if args.interval:
+        maintenance.run_forever(jobs)
+    else:
+        maintenance.run(jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import profiling
+
+# Upper bounds in seconds of the latency histograms' buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Nothing is recorded until `enable` is called, so the instrumented code
+# costs next to nothing when no one is scraping the metrics.
+enabled = False
+
+
+class Histogram:
+    """
+    Counts observations (e.g. latencies in seconds) in BUCKETS, separately for
+    each value of the `label` label.
+    """
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[label_value] = [0] * (len(BUCKETS) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for label_value, counts in series:
+            labels = '%s="%s"' % (self.label, _escape(label_value))
+            total = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                total += count
+                lines.append(
+                    '%s_bucket{%s,le="%s"} %s' % (self.name, labels, bound, total)
+                )
+            lines.append("%s_sum{%s} %s" % (self.name, labels, counts[-1]))
+            lines.append("%s_count{%s} %s" % (self.name, labels, total))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s counter" % self.name,
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_value, value in values:
+            lines.append(
+                '%s{%s="%s"} %s' % (self.name, self.label, _escape(label_value), value)
+            )
+        return lines
+
+
+class Gauge:
+    """
+    A value read when the metrics are scraped rather than kept up to date.
+    `collect` returns either a number or a dict of label value to number.
+    """
+
+    def __init__(self, name, help, collect, label=None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.label = label
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s gauge" % self.name,
+        ]
+        values = self.collect()
+        if isinstance(values, dict):
+            for label_value, value in sorted(values.items()):
+                lines.append(
+                    '%s{%s="%s"} %s'
+                    % (self.name, self.label, _escape(label_value), value)
+                )
+        else:
+            lines.append("%s %s" % (self.name, values))
+        return lines
+
+
+handler_seconds = Histogram(
+    "archivebot_handler_seconds",
+    "Time taken by each Bolt event handler.",
+    "handler",
+)
+handler_errors = Counter(
+    "archivebot_handler_errors_total",
+    "Exceptions raised by each Bolt event handler.",
+    "handler",
+)
+slack_api_seconds = Histogram(
+    "archivebot_slack_api_seconds",
+    "Time taken by each Slack Web API method, including rate limit waits.",
+    "method",
+)
+slack_api_rate_limited = Counter(
+    "archivebot_slack_api_rate_limited_total",
+    "Calls Slack answered with HTTP 429.",
+    "method",
+)
+events_skipped = Counter(
+    "archivebot_events_skipped_total",
+    "Events not handled: delivered again (duplicate) or turned away while "
+    "the job queue was full (busy).",
+    "reason",
+)
+searches_limited = Counter(
+    "archivebot_searches_limited_total",
+    "Searches turned away while the search workers were busy (busy), or "
+    "stopped by the time budget with some results (partial) or none "
+    "(timeout).",
+    "reason",
+)
+sql_seconds = Histogram(
+    "archivebot_sql_seconds",
+    "Time taken by each class of SQL work: insert (a batch of queued writes), "
+    "search, sync (users and channels) and lookup.",
+    "statement",
+)
+maintenance_seconds = Histogram(
+    "archivebot_maintenance_seconds",
+    "Time taken by each database maintenance job (see maintenance.py).",
+    "job",
+)
+maintenance_pages = Counter(
+    "archivebot_maintenance_pages_total",
+    "Pages checkpointed, vacuumed or backed up by each maintenance job.",
+    "job",
+)
+
+_metrics = [
+    handler_seconds,
+    handler_errors,
+    slack_api_seconds,
+    slack_api_rate_limited,
+    events_skipped,
+    searches_limited,
+    sql_seconds,
+    maintenance_seconds,
+    maintenance_pages,
+]
+_gauges = []
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def gauge(name, help, collect, label=None):
+    """
+    Adds a gauge whose value is read by calling `collect` on each scrape.
+    """
+    _gauges.append(Gauge(name, help, collect, label))
+
+
+@contextmanager
+def _timer(histogram, label_value):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(label_value, time.perf_counter() - start)
+
+
+_nothing = nullcontext()
+
+
+def timer(histogram, label_value):
+    """
+    Context manager recording how long its body takes in `histogram`, when
+    metrics are enabled.
+    """
+    if not enabled:
+        return _nothing
+    return _timer(histogram, label_value)
+
+
+def timed_handler(func):
+    """
+    Records the latency and errors of a Bolt handler, sync or async, and
+    logs it when it's slow (see profiling.py). Has to be applied before the
+    Bolt decorator, and after `enable` and profiling's setup: when metrics,
+    the slow log and the profiler are all off the handler is returned
+    untouched.
+    """
+    if not enabled and not profiling.active():
+        return func
+    name = func.__name__
+
+    def started():
+        if profiling.profiler:
+            profiling.profiler.start()
+        return time.perf_counter()
+
+    def finished(start, kwargs):
+        elapsed = time.perf_counter() - start
+        if enabled:
+            handler_seconds.observe(name, elapsed)
+        if profiling.is_slow(elapsed):
+            profiling.log_slow(
+                "handler", name, elapsed, args=profiling.event_shape(kwargs)
+            )
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = started()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if enabled:
+                    handler_errors.inc(name)
+                raise
+            finally:
+                finished(start, kwargs)
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = started()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if enabled:
+                    handler_errors.inc(name)
+                raise
+            finally:
+                finished(start, kwargs)
+
+    # The profiler samples the stacks below these
+    profiling.handler_codes.add(wrapper.__code__)
+
+    # Bolt passes handlers the arguments named in their signature, which
+    # it reads without following __wrapped__
+    wrapper.__signature__ = inspect.signature(func)
+    return wrapper
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics + _gauges:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,174 @@
+import calendar
+import datetime
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import PARTITION_MIGRATIONS, ProcessLocal, db_connect, migrate_db
+
+
+def month_of(ts):
+    """
+    Returns the month ("2021-03") of the partition a message timestamp
+    belongs in. Months are in UTC.
+    """
+    date = datetime.datetime.fromtimestamp(float(ts), datetime.timezone.utc)
+    return date.strftime("%Y-%m")
+
+
+def month_range(month):
+    """
+    Returns the first and last (exclusive) timestamps of a partition month.
+    """
+    year, month = map(int, month.split("-"))
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    end = calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+    return start, end
+
+
+def partition_path(database_path, month):
+    # slack.sqlite's partitions are slack.2021-03.sqlite, slack.2021-04.sqlite...
+    root, ext = os.path.splitext(database_path)
+    return "%s.%s%s" % (root, month, ext)
+
+
+class Partitions:
+    """
+    Partitioned storage of messages: one SQLite database per month next to
+    the archive database, so ingest and most searches only touch small
+    recent files instead of an index of the whole history.
+
+    The archive database keeps everything else (users, channels, visibility,
+    ...) and the list of partitions in its `partitions` table. Messages
+    archived before partitioning was enabled stay in its messages table,
+    which is searched as one more partition, and so do earlier messages
+    archived later on (see `month`). Each partition's connections have the
+    archive database attached as `archive`, so queries can refer to its
+    tables.
+
+    Partitioning is on once the `partitions` table lists a month.
+    """
+
+    def __init__(self, database_path, workers=4):
+        self.database_path = database_path
+        self.workers = workers
+
+        self._enabled = None
+        self._cutoff = None
+        self._migrated = set()
+        self._executor = ProcessLocal(
+            lambda: ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="partition"
+            )
+        )
+
+    def enabled(self):
+        # Checked once: a running bot doesn't notice import.py turning
+        # partitioning on until it's restarted
+        if self._enabled is None:
+            conn, cursor = db_connect(self.database_path)
+            try:
+                cursor.execute("SELECT 1 FROM partitions LIMIT 1")
+                enabled = cursor.fetchone() is not None
+                cursor.execute("SELECT ts FROM partition_cutoff")
+                row = cursor.fetchone()
+                self._cutoff = row[0] if row else None
+                self._enabled = enabled
+            except sqlite3.OperationalError:
+                # A database that hasn't been migrated yet
+                pass
+            cursor.close()
+        return bool(self._enabled)
+
+    def enable(self):
+        """
+        Turns partitioning on, starting with a partition for this month.
+        """
+        month = month_of(time.time())
+        self.connect(self.path(month))
+        conn, cursor = db_connect(self.database_path)
+        cursor.execute("SELECT 1 FROM partitions LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute("DELETE FROM partition_cutoff")
+            cursor.execute("INSERT INTO partition_cutoff SELECT MAX(ts) FROM messages")
+        self.register(cursor, month)
+        conn.commit()
+        cursor.execute("SELECT ts FROM partition_cutoff")
+        self._cutoff = cursor.fetchone()[0]
+        cursor.close()
+        self._enabled = True
+
+    def month(self, ts):
+        """
+        Returns the month of the partition a message belongs in, or None if
+        it belongs in the archive database: messages no newer than the last
+        one archived before partitioning was enabled go there, so a message
+        archived again (by a backfill or import) is always written where it
+        was first.
+        """
+        if self._cutoff is not None and float(ts) <= self._cutoff:
+            return None
+        return month_of(ts)
+
+    def register(self, cursor, month):
+        """
+        Adds a month to the archive's list of partitions, on a cursor of the
+        archive database. Doesn't commit: the partition is searched once it
+        has been committed.
+        """
+        cursor.execute("INSERT OR IGNORE INTO partitions(month) VALUES(?)", (month,))
+
+    def path(self, month):
+        return partition_path(self.database_path, month)
+
+    def months(self, since=None, until=None):
+        """
+        Returns the partition months, oldest first. With `since` or `until`,
+        only the months holding messages in [since, until).
+        """
+        conn, cursor = db_connect(self.database_path)
+        cursor.execute("SELECT month FROM partitions ORDER BY month")
+        months = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+
+        def overlaps(month):
+            start, end = month_range(month)
+            return (since is None or end > since) and (until is None or start < until)
+
+        return [month for month in months if overlaps(month)]
+
+    def paths(self, since=None, until=None):
+        """
+        Returns the databases that may hold messages in [since, until): the
+        archive database followed by the partitions.
+        """
+        return [self.database_path] + [
+            self.path(month) for month in self.months(since, until)
+        ]
+
+    def connect(self, path):
+        """
+        Same as utils.db_connect for the archive database or any of its
+        partitions. A partition that doesn't exist yet is created.
+        """
+        if path == self.database_path:
+            return db_connect(path)
+
+        conn, cursor = db_connect(path, attach={"archive": self.database_path})
+        if path not in self._migrated:
+            migrate_db(conn, cursor, PARTITION_MIGRATIONS)
+            self._migrated.add(path)
+        return conn, cursor
+
+    def map(self, func, paths):
+        """
+        Returns [func(cursor) for each path], run in parallel on a pool of
+        threads with a cursor on each database.
+        """
+
+        def run(path):
+            conn, cursor = self.connect(path)
+            return func(cursor)
+
+        return list(self._executor.get().map(run, paths))
@@ -0,0 +1,194 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from utils import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+# Slow operations are logged here, so they can be sent somewhere of their own
+slow_logger = logging.getLogger("slow_log")
+
+# Handlers and SQL taking at least this many seconds are logged, None for
+# none (see `enable_slow_log`)
+threshold = None
+
+# The sampling profiler, when it's on (see `enable_profiler`)
+profiler = None
+
+# Code of the wrappers metrics.timed_handler puts around Bolt handlers. The
+# profiler only keeps samples of stacks going through one of them.
+handler_codes = set()
+
+
+def enable_slow_log(seconds):
+    global threshold
+    threshold = seconds
+
+
+def enable_profiler(directory, interval=60):
+    global profiler
+    profiler = Profiler(directory, interval)
+
+
+def active():
+    """
+    Whether handlers need timing or sampling for the slow log or profiler.
+    """
+    return threshold is not None or profiler is not None
+
+
+def is_slow(seconds):
+    return threshold is not None and seconds >= threshold
+
+
+def shape(value):
+    """
+    Describes a value by its type and length rather than its content, e.g.
+    "str[12]".
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, (str, bytes, list, tuple, dict)):
+        return "%s[%d]" % (type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def event_shape(kwargs):
+    """
+    Describes the arguments a Bolt handler was called with: the type of the
+    event (or message) and the shape of everything else.
+    """
+    shapes = {}
+    for key, value in kwargs.items():
+        if isinstance(value, dict) and "type" in value:
+            shapes[key] = {
+                k: value[k] for k in ["type", "subtype", "channel_type"] if k in value
+            }
+            if "text" in value:
+                shapes[key]["text"] = shape(value["text"])
+        else:
+            shapes[key] = shape(value)
+    return shapes
+
+
+def explain(conn, sql, args):
+    """
+    Returns the EXPLAIN QUERY PLAN output of a statement, one line per step
+    indented like the sqlite3 shell does.
+    """
+    try:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, args).fetchall()
+    except sqlite3.Error as e:
+        return ["(%s)" % e]
+    depths = {0: -1}
+    lines = []
+    for id, parent, _, detail in rows:
+        depths[id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[id] + detail)
+    return lines
+
+
+def log_slow(kind, name, seconds, **details):
+    slow_logger.warning(
+        "Slow %s %s took %.3fs: %s"
+        % (kind, name, seconds, json.dumps(details, default=str))
+    )
+
+
+def log_slow_sql(name, seconds, conn, sql, args, rows, **details):
+    """
+    Logs a statement that took longer than the threshold with its plan, the
+    shapes of its arguments and the number of rows it returned.
+    """
+    if is_slow(seconds):
+        log_slow(
+            "sql",
+            name,
+            seconds,
+            sql=" ".join(sql.split()),
+            args=[shape(arg) for arg in args],
+            rows=rows,
+            plan=explain(conn, sql, args),
+            **details,
+        )
+
+
+class Profiler:
+    """
+    Samples the stacks of the threads running Bolt handlers every
+    `sample_interval` seconds, and every `interval` seconds writes how often
+    each stack was seen to `directory`.
+
+    Dumps are in the collapsed stack format ("outer;inner;leaf count" per
+    line) that flamegraph.pl and speedscope read. They're named after the
+    process, since each gunicorn worker profiles itself.
+    """
+
+    def __init__(self, directory, interval=60, sample_interval=0.01):
+        self.directory = directory
+        self.interval = interval
+        self.sample_interval = sample_interval
+
+        self._thread = ProcessLocal(self._start)
+
+    def start(self):
+        """
+        Starts sampling, unless it's already running in this process.
+        """
+        self._thread.get()
+
+    def _start(self):
+        thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        samples = collections.Counter()
+        next_dump = time.monotonic() + self.interval
+        while True:
+            time.sleep(self.sample_interval)
+            for frame in sys._current_frames().values():
+                stack = self._handler_stack(frame)
+                if stack:
+                    samples[stack] += 1
+
+            if time.monotonic() >= next_dump:
+                if samples:
+                    try:
+                        self._dump(samples)
+                    except OSError:
+                        logger.exception("Writing a profile failed")
+                samples = collections.Counter()
+                next_dump += self.interval
+
+    def _handler_stack(self, frame):
+        # The frames from the handler wrapper down, or None for threads that
+        # aren't running a handler
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            if code in handler_codes:
+                return ";".join(reversed(names))
+            names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return None
+
+    def _dump(self, samples):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(
+            self.directory,
+            "profile-%s-%s.txt" % (os.getpid(), time.strftime("%Y%m%d-%H%M%S")),
+        )
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write("%s %s\n" % (stack, count))
+        logger.info(
+            "Wrote a profile of %s samples to %s" % (sum(samples.values()), path)
+        )
@@ -0,0 +1,161 @@
+import datetime
+import re
+
+# Most results a search returns at once, so one DM can't flood the
+# conversation. Larger limits are lowered to this.
+MAX_LIMIT = 100
+
+
+def fts_query(terms):
+    """
+    Builds an FTS5 MATCH expression out of the search terms. Every term is
+    quoted so that punctuation in messages can't be read as FTS5 syntax, but
+    quoted phrases and trailing `*` prefixes keep their meaning.
+    """
+    parts = []
+    for term in terms:
+        prefix = term.endswith("*")
+        term = term.rstrip("*").strip('"').replace('"', "").strip()
+        if not term:
+            continue
+        parts.append('"%s"%s' % (term, "*" if prefix else ""))
+    return " ".join(parts)
+
+
+def date_range(value, today=None):
+    """
+    Returns the start and end (exclusive) of the period named by `value`, in
+    seconds since the Epoch, local time. `value` is a day (2021-03-14), a
+    month (2021-03), a year (2021), `today` or `yesterday`.
+    """
+    today = today or datetime.date.today()
+    if value == "today":
+        start = today
+        end = start + datetime.timedelta(days=1)
+    elif value == "yesterday":
+        start = today - datetime.timedelta(days=1)
+        end = today
+    elif re.fullmatch(r"\d{4}-\d{1,2}-\d{1,2}", value):
+        start = datetime.date(*map(int, value.split("-")))
+        end = start + datetime.timedelta(days=1)
+    elif re.fullmatch(r"\d{4}-\d{1,2}", value):
+        year, month = map(int, value.split("-"))
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    elif re.fullmatch(r"\d{4}", value):
+        start = datetime.date(int(value), 1, 1)
+        end = datetime.date(int(value) + 1, 1, 1)
+    else:
+        raise ValueError(
+            "%s not a valid date, use YYYY-MM-DD, YYYY-MM, YYYY, today or yesterday"
+            % value
+        )
+
+    def timestamp(date):
+        return datetime.datetime(date.year, date.month, date.day).timestamp()
+
+    return timestamp(start), timestamp(end)
+
+
+class SearchQuery:
+    """
+    A parsed search DM, passed to `search`. `since` and `until` bound the
+    timestamps of the messages searched (in seconds since the Epoch, `since`
+    inclusive and `until` exclusive) so they can be looked up in the ts index
+    instead of filtering every match.
+
+    `to_dict` and `from_dict` convert it to and from JSON-able dicts, to be
+    stored to continue the search later.
+    """
+
+    FIELDS = ["text", "user_name", "channel_name", "sort", "limit", "since", "until"]
+
+    def __init__(
+        self,
+        text=None,
+        user_name=None,
+        channel_name=None,
+        sort=None,
+        limit=10,
+        since=None,
+        until=None,
+    ):
+        self.text = text or []
+        self.user_name = user_name
+        self.channel_name = channel_name
+        self.sort = sort
+        self.limit = limit
+        self.since = since
+        self.until = until
+
+    @classmethod
+    def parse(cls, text, today=None):
+        """
+        Parses the text of a search DM. Raises ValueError if the query is
+        invalid.
+        """
+        query = cls()
+
+        # Slack likes to turn quotes into smart quotes
+        text = re.sub("[\u201c\u201d]", '"', text.lower())
+        params = re.findall(r'"[^"]*"?|\S+', text)
+        for p in params:
+            # Quoted phrases are always search text
+            if p[0] == '"':
+                query.text.append(p)
+                continue
+
+            # Handle emoji
+            # usual format is " :smiley_face: "
+            if len(p) > 2 and p[0] == ":" and p[-1] == ":":
+                query.text.append(p)
+                continue
+
+            p = p.split(":")
+
+            if len(p) == 1:
+                query.text.append(p[0])
+            if len(p) == 2:
+                if p[0] == "from":
+                    query.user_name = p[1]
+                if p[0] == "in":
+                    query.channel_name = p[1].replace("#", "").strip()
+                if p[0] == "sort":
+                    if p[1] in ["asc", "desc"]:
+                        query.sort = p[1]
+                    else:
+                        raise ValueError("Invalid sort order %s" % p[1])
+                if p[0] == "limit":
+                    try:
+                        limit = int(p[1])
+                    except:
+                        raise ValueError("%s not a valid number" % p[1])
+                    if limit < 1:
+                        raise ValueError("limit has to be at least 1")
+                    query.limit = min(limit, MAX_LIMIT)
+                if p[0] == "after":
+                    query.restrict(since=date_range(p[1], today)[1])
+                if p[0] == "before":
+                    query.restrict(until=date_range(p[1], today)[0])
+                if p[0] in ["during", "on"]:
+                    query.restrict(*date_range(p[1], today))
+
+        return query
+
+    def restrict(self, since=None, until=None):
+        # Several date operators all have to hold, so keep the narrowest range
+        if since is not None:
+            self.since = since if self.since is None else max(self.since, since)
+        if until is not None:
+            self.until = until if self.until is None else min(self.until, until)
+
+    def match(self):
+        return fts_query(self.text)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        # Searches stored before a field was added just don't have it
+        return cls(**dict((k, v) for k, v in d.items() if k in cls.FIELDS))
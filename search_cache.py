@@ -0,0 +1,92 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+class SearchCache:
+    """
+    LRU cache of search results.
+
+    Results are cached under the parsed query, the page it continues from and
+    the exact set of channels the searching user can see, so a user never
+    gets results cached for a different set of channels. Every entry belongs
+    to the database generation it was computed in (see the `generation`
+    table), and the whole cache is dropped as soon as the generation moves
+    on, i.e. whenever messages, memberships, channels or users change.
+
+    Holds at most `max_entries` results taking up roughly `max_bytes`.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def key(self, query, after, channels):
+        return (json.dumps(query, sort_keys=True), json.dumps(after), tuple(channels))
+
+    def get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, generation, value):
+        size = _size(key) + _size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._check_generation(generation)
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._generation = generation
+
+
+def _size(value):
+    """
+    Rough number of bytes taken up by a cached key or value.
+    """
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(_size(v) for v in value)
+    if isinstance(value, str):
+        return 50 + len(value)
+    return 32
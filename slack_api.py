@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slack_sdk.errors import SlackApiError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute allowed by each of Slack's rate limit tiers, and the
+# tier of each Web API method archive bot calls.
+# https://api.slack.com/docs/rate-limits
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    "conversations.history": 3,
+    "conversations.info": 3,
+    "conversations.list": 2,
+    "conversations.members": 4,
+    "conversations.replies": 3,
+    "users.info": 4,
+    "users.list": 2,
+}
+
+# Results requested per page from paginated methods
+PAGE_SIZE = 200
+
+# Share of each method's budget kept for live events: background work (e.g.
+# backfilling history) only makes a call while more than this is left
+BACKGROUND_RESERVE = 0.5
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per minute on average, with bursts of up to `burst`
+    calls (by default a minute's worth, as Slack tolerates short bursts above
+    the tier limits). `acquire` blocks until a call is allowed, and
+    `acquire_async` is the same for coroutines. With a `reserve`, a call is
+    only allowed while more than `reserve` calls would be left.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate / 60.0
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, reserve=0):
+        while True:
+            wait = self._take(reserve)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, reserve=0):
+        while True:
+            wait = self._take(reserve)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self, reserve=0):
+        # Takes a token and returns 0, or returns how long to wait for one
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._tokens >= 1 + reserve:
+                self._tokens -= 1
+                return 0
+            return (1 + reserve - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        """
+        Stops handing out calls for `seconds`, e.g. after Slack answers with
+        a Retry-After header.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class RateLimiter:
+    """
+    Keeps one token bucket per Web API method, sized from the method's tier,
+    so every caller in the process shares the same budget for each method.
+    """
+
+    def __init__(self, tier_limits=TIER_LIMITS):
+        self.tier_limits = tier_limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, method):
+        with self._lock:
+            if method not in self._buckets:
+                tier = METHOD_TIERS.get(method, 3)
+                self._buckets[method] = TokenBucket(self.tier_limits[tier])
+            return self._buckets[method]
+
+
+def call(client, limiter, method, background=False, **kwargs):
+    """
+    Calls a Web API method (e.g. "conversations.members") once the rate
+    limiter allows it. If Slack still answers with HTTP 429, waits for as long
+    as its Retry-After header asks and tries again. `background` calls leave
+    BACKGROUND_RESERVE of the method's budget to the others.
+    """
+    bucket = limiter.bucket(method)
+    reserve = bucket.capacity * BACKGROUND_RESERVE if background else 0
+    api_method = getattr(client, method.replace(".", "_"))
+    with metrics.timer(metrics.slack_api_seconds, method):
+        while True:
+            bucket.acquire(reserve)
+            try:
+                return api_method(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    raise
+                if metrics.enabled:
+                    metrics.slack_api_rate_limited.inc(method)
+                retry_after = int(e.response.headers.get("Retry-After", 1))
+                logger.warning(
+                    "Rate limited on %s, retrying in %ss" % (method, retry_after)
+                )
+                bucket.pause(retry_after)
+
+
+async def async_call(client, limiter, method, **kwargs):
+    """
+    Same as `call` for an AsyncWebClient, waiting without blocking the event
+    loop. Shares the limiter's budget with any synchronous callers.
+    """
+    bucket = limiter.bucket(method)
+    api_method = getattr(client, method.replace(".", "_"))
+    with metrics.timer(metrics.slack_api_seconds, method):
+        while True:
+            await bucket.acquire_async()
+            try:
+                return await api_method(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    raise
+                if metrics.enabled:
+                    metrics.slack_api_rate_limited.inc(method)
+                retry_after = int(e.response.headers.get("Retry-After", 1))
+                logger.warning(
+                    "Rate limited on %s, retrying in %ss" % (method, retry_after)
+                )
+                bucket.pause(retry_after)
+
+
+def paginate(client, limiter, method, key, background=False, **kwargs):
+    """
+    Yields every item under `key` from a paginated Web API method, following
+    `response_metadata.next_cursor` until Slack runs out of pages.
+    """
+    cursor = None
+    while True:
+        response = call(
+            client,
+            limiter,
+            method,
+            background=background,
+            limit=PAGE_SIZE,
+            cursor=cursor,
+            **kwargs,
+        )
+        yield from response[key]
+
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+async def async_paginate(client, limiter, method, key, **kwargs):
+    """
+    Same as `paginate` for an AsyncWebClient.
+    """
+    cursor = None
+    while True:
+        response = await async_call(
+            client, limiter, method, limit=PAGE_SIZE, cursor=cursor, **kwargs
+        )
+        for item in response[key]:
+            yield item
+
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+def fetch_users(client, limiter):
+    return list(paginate(client, limiter, "users.list", "members"))
+
+
+def fetch_channels(client, limiter):
+    return list(
+        paginate(
+            client,
+            limiter,
+            "conversations.list",
+            "channels",
+            types="public_channel,private_channel",
+        )
+    )
+
+
+def fetch_members(client, limiter, channel_ids, workers=8):
+    """
+    Returns a dict of channel ID to the list of its members' user IDs. Up to
+    `workers` channels are fetched at the same time.
+    """
+
+    def members(channel_id):
+        return list(
+            paginate(
+                client, limiter, "conversations.members", "members", channel=channel_id
+            )
+        )
+
+    channel_ids = list(channel_ids)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(channel_ids, pool.map(members, channel_ids)))
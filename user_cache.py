@@ -0,0 +1,67 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """
+    Remembers which user IDs are known to be in the users table, so archiving
+    a message doesn't need a database query to check its author exists.
+
+    At most `max_size` IDs are kept, least recently used first out, and each
+    is trusted for `ttl` seconds. When `ensure` is asked about an ID that
+    isn't cached, `lookup(user_id)` is run on a background thread to add the
+    user. Misses for an ID that is already being looked up share that lookup.
+    """
+
+    def __init__(self, lookup, max_size=50000, ttl=3600, workers=2):
+        self.lookup = lookup
+        self.max_size = max_size
+        self.ttl = ttl
+        self.workers = workers
+
+        self._users = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ProcessLocal(
+            lambda: ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="user-lookup"
+            )
+        )
+
+    def add(self, user_id):
+        with self._lock:
+            self._users[user_id] = time.monotonic() + self.ttl
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def ensure(self, user_id):
+        """
+        Returns straight away. If `user_id` isn't cached, makes sure a lookup
+        for it is running.
+        """
+        with self._lock:
+            expires = self._users.get(user_id)
+            if expires is not None and expires > time.monotonic():
+                self._users.move_to_end(user_id)
+                return
+            if user_id in self._pending:
+                return
+            self._pending[user_id] = self._executor.get().submit(self._lookup, user_id)
+
+    def _lookup(self, user_id):
+        try:
+            self.lookup(user_id)
+            self.add(user_id)
+        except Exception:
+            logger.exception("Failed to look up user %s" % user_id)
+        finally:
+            with self._lock:
+                del self._pending[user_id]
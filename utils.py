@@ -1,7 +1,137 @@
+import atexit
+import logging
+import os
 import sqlite3
+import threading
 
+logger = logging.getLogger(__name__)
 
-def migrate_db(conn, cursor):
+
+# `visibility` user for public channels, which every user can search
+EVERYONE = "*"
+
+
+def channel_visibility(channel_id, is_private, members):
+    """
+    Returns the `visibility` rows for a channel archive bot is a member of.
+    """
+    if not is_private:
+        return [(EVERYONE, channel_id)]
+    return [(user, channel_id) for user in members]
+
+
+def sync_rows(cursor, table, key_columns, value_columns, rows, delete=True):
+    """
+    Makes `table` match `rows`, touching only the rows that differ.
+
+    `rows` are tuples of the key columns followed by the value columns. Rows
+    whose key isn't in the table are inserted, rows whose values differ are
+    updated and, if `delete` is set, rows missing from `rows` are deleted.
+    Doesn't commit. Returns the number of rows added, changed and removed.
+    """
+    columns = key_columns + value_columns
+    n_keys = len(key_columns)
+
+    cursor.execute("SELECT %s FROM %s" % (", ".join(columns), table))
+    current = {row[:n_keys]: row[n_keys:] for row in cursor.fetchall()}
+    desired = {tuple(row[:n_keys]): tuple(row[n_keys:]) for row in rows}
+
+    added = [k + v for k, v in desired.items() if k not in current]
+    changed = [v + k for k, v in desired.items() if k in current and current[k] != v]
+    removed = [k for k in current if k not in desired] if delete else []
+
+    where = " AND ".join("%s = ?" % c for c in key_columns)
+    cursor.executemany(
+        "INSERT INTO %s(%s) VALUES(%s)"
+        % (table, ", ".join(columns), ", ".join("?" * len(columns))),
+        added,
+    )
+    if value_columns:
+        cursor.executemany(
+            "UPDATE %s SET %s WHERE %s"
+            % (table, ", ".join("%s = ?" % c for c in value_columns), where),
+            changed,
+        )
+    cursor.executemany("DELETE FROM %s WHERE %s" % (table, where), removed)
+
+    return len(added), len(changed), len(removed)
+
+
+def _column_names(cursor, table):
+    # table_xinfo includes generated columns, table_info doesn't
+    cursor.execute("PRAGMA table_xinfo(%s)" % table)
+    return [row[1] for row in cursor.fetchall()]
+
+
+# Triggers keeping messages_fts in sync with messages
+FTS_TRIGGERS = {
+    "messages_fts_insert": """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts(rowid, message) VALUES (new.rowid, new.message);
+        END
+    """,
+    "messages_fts_delete": """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, message)
+            VALUES ('delete', old.rowid, old.message);
+        END
+    """,
+    "messages_fts_update": """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages
+        BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, message)
+            VALUES ('delete', old.rowid, old.message);
+            INSERT INTO messages_fts(rowid, message) VALUES (new.rowid, new.message);
+        END
+    """,
+}
+
+# Secondary indexes on messages
+MESSAGE_INDEXES = {
+    "messages_ts": "CREATE INDEX IF NOT EXISTS messages_ts ON messages(ts)",
+    "messages_channel_ts": (
+        "CREATE INDEX IF NOT EXISTS messages_channel_ts ON messages(channel, ts)"
+    ),
+    "messages_user_ts": (
+        "CREATE INDEX IF NOT EXISTS messages_user_ts ON messages(user, ts)"
+    ),
+}
+
+
+def drop_message_indexes(cursor):
+    """
+    Drops the secondary indexes and full-text triggers on messages, for bulk
+    loading. `rebuild_message_indexes` puts them back. Doesn't commit.
+    """
+    for name in FTS_TRIGGERS:
+        cursor.execute("DROP TRIGGER IF EXISTS %s" % name)
+    for name in MESSAGE_INDEXES:
+        cursor.execute("DROP INDEX IF EXISTS %s" % name)
+
+
+def message_indexes_dropped(cursor):
+    cursor.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+        ("messages_fts_insert",),
+    )
+    return cursor.fetchone()[0] == 0
+
+
+def rebuild_message_indexes(cursor):
+    """
+    Recreates what `drop_message_indexes` dropped and reindexes every message
+    for full-text search. Doesn't commit.
+    """
+    for sql in MESSAGE_INDEXES.values():
+        cursor.execute(sql)
+    for sql in FTS_TRIGGERS.values():
+        cursor.execute(sql)
+    cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def _create_tables(cursor):
     cursor.execute(
         """
         CREATE TABLE IF NOT EXISTS messages (
@@ -41,10 +171,9 @@ def migrate_db(conn, cursor):
         )
     """
     )
-    conn.commit()
 
     # Add `is_private` to channels for dbs that existed in v0.1
-    try:
+    if "is_private" not in _column_names(cursor, "channels"):
         cursor.execute(
             """
             ALTER TABLE channels
@@ -52,12 +181,407 @@ def migrate_db(conn, cursor):
             NOT NULL CHECK (is_private IN (0,1))
         """
         )
-        conn.commit()
-    except:
-        pass
 
 
-def db_connect(database_path):
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
-    return conn, cursor
+def _add_visibility(cursor):
+    # The channels each user can search: public channels archive bot is a
+    # member of (stored once, for the EVERYONE user) and the private channels
+    # archive bot shares with the user. Kept up to date by the event handlers
+    # and update_channels() so searches don't have to work it out from
+    # channels and members every time.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS visibility (
+            user TEXT,
+            channel TEXT,
+            PRIMARY KEY (user, channel)
+        ) WITHOUT ROWID
+    """
+    )
+
+
+def _add_full_text_index(cursor):
+    # Full-text index over messages.message, kept in sync by triggers. The
+    # index doesn't store its own copy of the text (content=messages), so it
+    # has to be told about every insert, update and delete.
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message,
+            content=messages,
+            content_rowid=rowid
+        )
+    """
+    )
+    for sql in FTS_TRIGGERS.values():
+        cursor.execute(sql)
+    # Index any messages archived before the full-text index existed
+    if not fts_exists:
+        cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def _add_indexes(cursor):
+    # Numeric copy of the message timestamp for sorting and range queries.
+    # It's a virtual generated column, so adding it doesn't rewrite the table
+    # and inserts don't need to know about it.
+    if "ts" not in _column_names(cursor, "messages"):
+        cursor.execute(
+            """
+            ALTER TABLE messages
+            ADD COLUMN ts REAL GENERATED ALWAYS AS (CAST(timestamp AS REAL)) VIRTUAL
+        """
+        )
+    for sql in MESSAGE_INDEXES.values():
+        cursor.execute(sql)
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_name ON users(name)")
+
+    # Older versions added every membership again on each restart
+    cursor.execute(
+        """
+        DELETE FROM members WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM members GROUP BY channel, user
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS members_channel_user ON members(channel, user)"
+    )
+
+
+def _add_import_manifest(cursor):
+    # The export files import.py has finished importing
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imported_files (
+            path TEXT PRIMARY KEY,
+            messages INTEGER
+        )
+    """
+    )
+
+
+def _add_import_file_hashes(cursor):
+    # Lets import.py tell which export files changed since they were imported
+    columns = _column_names(cursor, "imported_files")
+    for column, column_type in [
+        ("size", "INTEGER"),
+        ("mtime", "REAL"),
+        ("sha1", "TEXT"),
+    ]:
+        if column not in columns:
+            cursor.execute(
+                "ALTER TABLE imported_files ADD COLUMN %s %s" % (column, column_type)
+            )
+
+
+def _add_search_cursors(cursor):
+    # Where each user's last search left off, for the `next` command
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS search_cursors (
+            user TEXT PRIMARY KEY,
+            token TEXT
+        )
+    """
+    )
+
+
+def _add_generation(cursor):
+    # A counter bumped by every change that can affect search results, so
+    # cached results can be checked with a single lookup
+    cursor.execute("CREATE TABLE IF NOT EXISTS generation (value INTEGER NOT NULL)")
+    cursor.execute(
+        "INSERT INTO generation SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM generation)"
+    )
+    for table, events in [
+        ("messages", ["INSERT", "UPDATE", "DELETE"]),
+        ("visibility", ["INSERT", "DELETE"]),
+        ("channels", ["INSERT", "UPDATE"]),
+        ("users", ["INSERT", "UPDATE"]),
+    ]:
+        for event in events:
+            cursor.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS %s_%s_generation AFTER %s ON %s
+                BEGIN
+                    UPDATE generation SET value = value + 1;
+                END
+            """
+                % (table, event.lower(), event, table)
+            )
+
+
+def _add_partitions(cursor):
+    # The monthly partitions holding messages when the archive is partitioned
+    # (see partitions.py). Empty otherwise.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS partitions (
+            month TEXT PRIMARY KEY
+        ) WITHOUT ROWID
+    """
+    )
+
+
+def _add_backfills(cursor):
+    # How far back backfill.py has archived each channel's history: the
+    # timestamp of the oldest message so far, and whether it's finished
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backfills (
+            channel TEXT PRIMARY KEY,
+            latest TEXT,
+            done INTEGER NOT NULL DEFAULT 0
+        )
+    """
+    )
+
+
+def _add_partition_cutoff(cursor):
+    # Messages up to this timestamp belong in the archive database once it's
+    # partitioned: the newest message archived before partitioning was
+    # turned on (see Partitions.month). For archives partitioned before the
+    # cutoff was kept, that's still the newest message there.
+    cursor.execute("CREATE TABLE IF NOT EXISTS partition_cutoff (ts REAL)")
+    cursor.execute(
+        """
+        INSERT INTO partition_cutoff SELECT MAX(ts) FROM messages
+        WHERE EXISTS (SELECT 1 FROM partitions)
+            AND NOT EXISTS (SELECT 1 FROM partition_cutoff)
+    """
+    )
+
+
+def _add_recent_events(cursor):
+    # IDs of the events archive bot accepted, until they expire, so every
+    # worker process can skip the ones Slack delivers again (see
+    # jobs.RecentEvents)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recent_events (
+            id TEXT PRIMARY KEY,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID
+    """
+    )
+
+
+def _create_partition(cursor):
+    # A partition only holds messages, with the same columns, full-text index
+    # and indexes as the messages table of the archive database
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            message TEXT,
+            user TEXT,
+            channel TEXT,
+            timestamp TEXT,
+            ts REAL GENERATED ALWAYS AS (CAST(timestamp AS REAL)) VIRTUAL,
+            UNIQUE(channel, timestamp) ON CONFLICT REPLACE
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message,
+            content=messages,
+            content_rowid=rowid
+        )
+    """
+    )
+    for sql in FTS_TRIGGERS.values():
+        cursor.execute(sql)
+    for sql in MESSAGE_INDEXES.values():
+        cursor.execute(sql)
+
+
+# Schema migrations, in order. The number of migrations applied to a database
+# is stored in its user_version, so only new ones run. Databases from before
+# versioning have user_version 0, so every migration has to cope with the
+# change it makes already being there.
+MIGRATIONS = [
+    _create_tables,
+    _add_visibility,
+    _add_full_text_index,
+    _add_indexes,
+    _add_import_manifest,
+    _add_import_file_hashes,
+    _add_search_cursors,
+    _add_generation,
+    _add_partitions,
+    _add_backfills,
+    _add_partition_cutoff,
+    _add_recent_events,
+]
+
+# Schema migrations of partition databases
+PARTITION_MIGRATIONS = [
+    _create_partition,
+]
+
+
+def migrate_db(conn, cursor, migrations=MIGRATIONS):
+    """
+    Brings the database schema up to date, by default that of the archive
+    database. Partitions are migrated with PARTITION_MIGRATIONS.
+
+    Each migration runs in its own transaction together with the bump of
+    user_version, so an interrupted upgrade resumes from the last finished
+    step. Thanks to WAL, searches keep working while a migration builds its
+    indexes; archive writes wait for it.
+    """
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+
+    for number, migration in enumerate(migrations[version:], start=version + 1):
+        logger.info(
+            "Migrating database to version %s (%s)" % (number, migration.__name__)
+        )
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute("PRAGMA user_version = %d" % number)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+# Connection settings applied to every pooled connection. WAL lets searches
+# keep reading while another thread or gunicorn worker is writing, and
+# busy_timeout makes writers wait for each other instead of failing with
+# "database is locked".
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KB = 64 * 1024
+# Size the WAL is truncated back to after a checkpoint resets it
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+_local = threading.local()
+_connections = []
+# Bumped by close_connections() so threads drop the connections it closed
+_pool_generation = 0
+_connections_lock = threading.Lock()
+
+
+def _open_connection(database_path, attach):
+    # check_same_thread is off so close_connections() can close every
+    # thread's connection at shutdown. Each connection is otherwise only
+    # ever used by the thread that opened it.
+    conn = sqlite3.connect(
+        database_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+    )
+    # Lets maintenance.py give free pages back to the filesystem without a
+    # full VACUUM. Only set on new databases: it only takes effect when the
+    # database is created, and on an existing one it waits for the write
+    # lock. maintenance.py --convert turns it on for older databases.
+    if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA journal_size_limit = %d" % JOURNAL_SIZE_LIMIT)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = %d" % BUSY_TIMEOUT_MS)
+    conn.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+    conn.execute("PRAGMA cache_size = -%d" % CACHE_SIZE_KB)
+    # `ON CONFLICT REPLACE` on messages only fires the delete trigger (which
+    # keeps messages_fts in sync) when recursive triggers are enabled.
+    conn.execute("PRAGMA recursive_triggers = ON")
+    for name, path in attach.items():
+        conn.execute("ATTACH DATABASE ? AS %s" % name, (path,))
+    return conn
+
+
+def db_connect(database_path, attach=None):
+    """
+    Returns a connection and a new cursor for `database_path`, with the
+    databases in `attach` (a dict of schema name to path) attached.
+
+    Connections are pooled: each thread gets one connection per database which
+    is reused for every call. gunicorn forks its workers after `init()` has
+    already connected in the master, so connections are never shared across
+    processes either.
+    """
+    pid = os.getpid()
+    if (getattr(_local, "pid", None), getattr(_local, "generation", None)) != (
+        pid,
+        _pool_generation,
+    ):
+        _local.pid = pid
+        _local.generation = _pool_generation
+        _local.connections = {}
+
+    conn = _local.connections.get(database_path)
+    if conn is None:
+        conn = _open_connection(database_path, attach or {})
+        _local.connections[database_path] = conn
+        with _connections_lock:
+            _connections.append((pid, conn))
+    elif conn.in_transaction:
+        # A previous handler failed before committing. Don't let its
+        # half-finished transaction hold the write lock.
+        logger.warning("Rolling back abandoned transaction on %s" % database_path)
+        conn.rollback()
+
+    return conn, conn.cursor()
+
+
+def close_connections():
+    """
+    Closes every pooled connection opened by this process. Registered to run
+    at exit so WAL checkpoints aren't left waiting on idle connections.
+    """
+    global _pool_generation
+
+    pid = os.getpid()
+    with _connections_lock:
+        for conn_pid, conn in _connections:
+            if conn_pid == pid:
+                conn.close()
+        _connections.clear()
+        _pool_generation += 1
+
+
+atexit.register(close_connections)
+
+
+class ProcessLocal:
+    """
+    Something started on first use in each process, like worker threads or
+    a thread pool. gunicorn forks its workers after the app has been loaded
+    (and may have started them already), and threads don't survive a fork,
+    so a forked process starts its own.
+    """
+
+    def __init__(self, start):
+        self.start = start
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._value = None
+
+    def get(self):
+        """
+        Returns what `start()` returned in this process, calling it first if
+        it hasn't been yet.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.start()
+                    self._pid = os.getpid()
+        return self._value
+
+    def started(self):
+        return self._pid == os.getpid()
+
+    def reset(self):
+        """
+        Forgets what was started, so the next `get` starts it again.
+        """
+        self._pid = None
+        self._value = None
@@ -0,0 +1,252 @@
+import collections
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+import profiling
+from utils import ProcessLocal, db_connect
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the queue when the writer is being shut down
+_STOP = object()
+
+# SQLite result codes for a lock held by another connection (SQLITE_BUSY,
+# SQLITE_LOCKED). Writes failing with these go through once it's released, so
+# they're retried. Any other error (no such table, disk full, corruption...)
+# won't go away by itself.
+RETRIED_ERROR_CODES = (5, 6)
+# Seconds before retrying a batch that couldn't be committed, doubled after
+# each failure up to RETRY_MAX_DELAY
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+# Seconds `close` keeps retrying for, so shutting down can't hang on a lock
+# that's never released
+CLOSE_RETRY_TIMEOUT = 10
+
+
+class WriteQueue:
+    """
+    Batches writes to the archive database on a dedicated writer thread.
+
+    Handlers enqueue statements with `execute` and `executemany` and return
+    straight away. The writer commits everything queued so far in a single
+    transaction once `max_batch` statements are waiting or the oldest one has
+    waited `max_latency` seconds, so busy channels cost one fsync per batch
+    instead of one per message. Statements are applied in the order they were
+    queued.
+
+    The queue holds at most `max_size` statements; once it's full, callers
+    block until the writer catches up. A batch that can't be committed while
+    another process holds the write lock is retried until it is (for at most
+    CLOSE_RETRY_TIMEOUT seconds once the queue is being closed). A batch that
+    fails otherwise is tried one statement at a time, and the statements
+    that still fail are dropped.
+
+    A statement can be queued for another database than `database_path`
+    (e.g. a partition), opened with `connect`. Each database of a batch is
+    committed separately, the others before `database_path`.
+    """
+
+    def __init__(
+        self,
+        database_path,
+        max_latency=0.2,
+        max_batch=500,
+        max_size=10000,
+        connect=db_connect,
+    ):
+        self.database_path = database_path
+        self.connect = connect
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.max_size = max_size
+
+        self._writer = ProcessLocal(self._start)
+        self._retry_deadline = None
+
+    def execute(self, sql, args=(), database_path=None):
+        self._put((sql, args, False, database_path or self.database_path))
+
+    def executemany(self, sql, args, database_path=None):
+        self._put((sql, list(args), True, database_path or self.database_path))
+
+    def flush(self):
+        """
+        Blocks until everything queued before the call has been committed.
+        """
+        if self._running():
+            done = threading.Event()
+            self._writer.get()[0].put(done)
+            done.wait()
+
+    def close(self):
+        """
+        Commits everything still queued and stops the writer thread.
+        """
+        if self._running():
+            write_queue, thread = self._writer.get()
+            self._retry_deadline = time.monotonic() + CLOSE_RETRY_TIMEOUT
+            write_queue.put(_STOP)
+            thread.join()
+            self._writer.reset()
+            self._retry_deadline = None
+
+    def depth(self):
+        return self._writer.get()[0].qsize() if self._running() else 0
+
+    def _running(self):
+        return self._writer.started() and self._writer.get()[1].is_alive()
+
+    def _put(self, item):
+        self._writer.get()[0].put(item)
+
+    def _start(self):
+        write_queue = queue.Queue(self.max_size)
+        thread = threading.Thread(
+            target=self._run, args=(write_queue,), name="archive-writer", daemon=True
+        )
+        thread.start()
+        return write_queue, thread
+
+    def _run(self, write_queue):
+        stopping = False
+        while not stopping:
+            batch = []
+            waiting = []
+
+            item = write_queue.get()
+            deadline = time.monotonic() + self.max_latency
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiting.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = write_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            # The writer must never die: nothing would restart it, and
+            # everything queued after would be lost
+            try:
+                if batch:
+                    with metrics.timer(metrics.sql_seconds, "insert"):
+                        self._commit(batch)
+            except Exception:
+                logger.exception("Writing a batch of %s statements failed" % len(batch))
+            finally:
+                for done in waiting:
+                    done.set()
+
+    def _commit(self, batch):
+        # Partitions first: the archive database may record what was written
+        # to them, which shouldn't be committed unless they were
+        batches = {}
+        for op in batch:
+            batches.setdefault(op[3], []).append(op)
+        main = batches.pop(self.database_path, None)
+        for database_path, ops in batches.items():
+            self._commit_to(database_path, ops)
+        if main:
+            self._commit_to(self.database_path, main)
+
+    def _commit_to(self, database_path, batch):
+        try:
+            self._commit_until_done(database_path, batch)
+            return
+        except sqlite3.Error:
+            logger.exception(
+                "Batch of %s writes failed, retrying one at a time" % len(batch)
+            )
+
+        # Apply the statements individually so one bad write doesn't lose
+        # the whole batch
+        for op in batch:
+            try:
+                self._commit_until_done(database_path, [op])
+            except sqlite3.Error:
+                logger.exception("Dropping write: %s %s" % (op[0], op[1]))
+
+    def _commit_until_done(self, database_path, batch):
+        """
+        Commits `batch` in one transaction, trying the whole batch again
+        after a growing delay for as long as the database is locked (see
+        RETRIED_ERROR_CODES). Any other error is raised, and so is a lock
+        once the queue has been closing for CLOSE_RETRY_TIMEOUT seconds.
+        """
+        delay = RETRY_DELAY
+        while True:
+            conn = None
+            try:
+                conn, cursor = self.connect(database_path)
+                start = time.perf_counter()
+                for op in batch:
+                    self._apply(cursor, op)
+                conn.commit()
+                self._log_if_slow(database_path, batch, time.perf_counter() - start)
+                return
+            except Exception as e:
+                if conn is not None:
+                    try:
+                        conn.rollback()
+                    except sqlite3.Error:
+                        pass
+                if not _is_locked(e):
+                    raise
+                deadline = self._retry_deadline
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                logger.warning(
+                    "Writing %s statements to %s failed (%s), retrying in %.1fs"
+                    % (len(batch), database_path, e, delay)
+                )
+            deadline = self._retry_deadline
+            if deadline is not None:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+            delay = min(max(delay, RETRY_DELAY) * 2, RETRY_MAX_DELAY)
+
+    def _log_if_slow(self, database_path, batch, seconds):
+        if not profiling.is_slow(seconds):
+            return
+        statements = collections.Counter(" ".join(op[0].split()) for op in batch)
+        profiling.log_slow(
+            "sql",
+            "insert",
+            seconds,
+            database=database_path,
+            rows=sum(len(op[1]) if op[2] else 1 for op in batch),
+            statements=dict(statements),
+        )
+
+    def _apply(self, cursor, op):
+        sql, args, many, database_path = op
+        if many:
+            cursor.executemany(sql, args)
+        else:
+            cursor.execute(sql, args)
+
+
+def _is_locked(e):
+    if not isinstance(e, sqlite3.Error):
+        return False
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is None:
+        # Python before 3.11 only says so in the message
+        return "locked" in str(e) or "busy" in str(e)
+    # Extended codes (e.g. SQLITE_BUSY_SNAPSHOT) keep the primary code in the
+    # low byte
+    return (code & 0xFF) in RETRIED_ERROR_CODES